@@ -4,6 +4,8 @@ from dataclasses import dataclass
 import math
 from typing import Type
 
+import numpy as np
+
 from Environment import Stimulus
 
 @dataclass
@@ -72,12 +74,18 @@ class AdaptiveType:
             'kay',
         ]
 
+    # Parameters that only appear in the model multiplied by some others. When they're
+    # fitted together with any of those, only their product can be identified.
+    @classmethod
+    def product_parameters(cls) -> dict[str, list[str]]:
+        return {}
+
     @classmethod
     def should_plot_macknhall(cls) -> bool:
         return 'alpha_mack' in cls.parameters() and 'alpha_hall' in cls.parameters()
 
     @classmethod
-    def initial_defaults(cls) -> dict[str, float]:
+    def initial_defaults(cls) -> dict[str, None | float]:
         return dict(
             alpha = 0.1,
             alpha_mack = 0.1,
@@ -94,6 +102,8 @@ class AdaptiveType:
             nu = 0.25,
             kay = 2,
             num_trials = 100,
+            seed = 0,
+            tolerance = None,
         )
 
     @classmethod
@@ -130,14 +140,71 @@ class AdaptiveType:
     def step(self, s: Stimulus, rp: RunParameters):
         raise NotImplementedError('Calling step in abstract function is undefined.')
 
+    @classmethod
+    def supports_arrays(cls) -> bool:
+        return cls.step_arrays is not AdaptiveType.step_arrays
+
+    def run_step_arrays(self, s, rp: RunParameters):
+        self.delta_v_factor = rp.beta * (rp.lamda - rp.sigma)
+        self.step_arrays(s, rp)
+
+    # step_arrays is the struct-of-arrays version of step used by Kernel.
+    # Every attribute of `s` and `rp` is a numpy array with one row per copy of the
+    # environment, and `s` has one column per CS. Values are only committed for the
+    # CS that are present in the trial, so implementations must assign new arrays
+    # to the attributes of `s` rather than modifying them in place.
+    def step_arrays(self, s, rp: RunParameters):
+        raise NotImplementedError('Calling step_arrays in abstract function is undefined.')
+
+    @classmethod
+    def supports_fast_forward(cls) -> bool:
+        return cls.fast_forward is not AdaptiveType.fast_forward
+
+    # fast_forward computes the associative strengths of the stimuli `s` of a compound
+    # after each of `n` identical trials in closed form, and returns them as an array
+    # of shape (n, len(s)). It returns None when it can't be done from the current
+    # state, in which case the next trial is run normally.
+    # Models can only implement this if assoc is the only value changed by the trials.
+    def fast_forward(self, s: list[Stimulus], rp: RunParameters, n: int) -> None | np.ndarray:
+        return None
+
+# Associative strengths of a compound after each of `n` identical Rescorla-Wagner
+# trials. Every CS learns from the same prediction error e = λ - ΣV, which shrinks
+# by a factor of r = 1 - β Σα on every trial, so after k trials
+#   V_k = V_0 + α β e_0 (1 - r^k) / (1 - r).
+def rescorla_wagner_trials(alphas: np.ndarray, assocs: np.ndarray, beta: float, lamda: float, n: int) -> np.ndarray:
+    error = lamda - sum(assocs.tolist())
+    ratio = 1 - beta * alphas.sum()
+    trials = np.arange(1, n + 1)
+
+    if ratio == 1:
+        total = trials.astype(float)
+    else:
+        total = (1 - ratio ** trials) / (1 - ratio)
+
+    return assocs + np.outer(total, alphas * beta * error)
+
 class RescorlaWagner(AdaptiveType):
     @classmethod
     def parameters(cls) -> list[str]:
         return ['alpha', 'beta', 'betan', 'lamda']
 
+    # The change of the associative strength is alpha * beta * (lamda - sigma).
+    @classmethod
+    def product_parameters(cls) -> dict[str, list[str]]:
+        return {'alpha': ['beta', 'betan']}
+
     def step(self, s: Stimulus, rp: RunParameters):
         s.assoc += s.alpha * self.delta_v_factor
 
+    def step_arrays(self, s, rp: RunParameters):
+        s.assoc = s.assoc + s.alpha * self.delta_v_factor
+
+    def fast_forward(self, s: list[Stimulus], rp: RunParameters, n: int) -> None | np.ndarray:
+        alphas = np.array([x.alpha for x in s])
+        assocs = np.array([x.assoc for x in s])
+        return rescorla_wagner_trials(alphas, assocs, rp.beta, rp.lamda, n)
+
 class RescorlaWagnerLinear(AdaptiveType):
     @classmethod
     def parameters(cls) -> list[str]:
@@ -148,6 +215,19 @@ class RescorlaWagnerLinear(AdaptiveType):
         s.alpha = min(max(s.alpha, 0.05), 1)
         s.assoc += s.alpha * self.delta_v_factor
 
+    def step_arrays(self, s, rp: RunParameters):
+        s.alpha = np.minimum(np.maximum(s.alpha * (1 + rp.sign * 0.05), 0.05), 1)
+        s.assoc = s.assoc + s.alpha * self.delta_v_factor
+
+    # Once every alpha is clamped, the model is the same as Rescorla-Wagner.
+    def fast_forward(self, s: list[Stimulus], rp: RunParameters, n: int) -> None | np.ndarray:
+        alphas = np.array([x.alpha for x in s])
+        if not np.array_equal(np.minimum(np.maximum(alphas * (1 + rp.sign * 0.05), 0.05), 1), alphas):
+            return None
+
+        assocs = np.array([x.assoc for x in s])
+        return rescorla_wagner_trials(alphas, assocs, rp.beta, rp.lamda, n)
+
 class PearceHall(AdaptiveType):
     @classmethod
     def parameters(cls) -> list[str]:
@@ -173,6 +253,15 @@ class PearceKayeHall(AdaptiveType):
         s.alpha = self.gamma * abs(rho) + (1 - self.gamma) * s.alpha
         s.assoc = s.Ve - s.Vi
 
+    def step_arrays(self, s, rp: RunParameters):
+        rho = rp.lamda - (rp.sigmaE - rp.sigmaI)
+
+        s.Ve = np.where(rho >= 0, s.Ve + self.betap * s.alpha * rp.lamda, s.Ve)
+        s.Vi = np.where(rho >= 0, s.Vi, s.Vi + self.betan * s.alpha * abs(rho))
+
+        s.alpha = self.gamma * abs(rho) + (1 - self.gamma) * s.alpha
+        s.assoc = s.Ve - s.Vi
+
 class LePelley(AdaptiveType):
     @classmethod
     def parameters(cls) -> list[str]:
@@ -201,6 +290,24 @@ class LePelley(AdaptiveType):
 
         s.assoc = s.Ve - s.Vi
 
+    def step_arrays(self, s, rp: RunParameters):
+        rho = rp.lamda - (rp.sigmaE - rp.sigmaI)
+
+        VXe = rp.sigmaE - s.Ve
+        VXi = rp.sigmaI - s.Vi
+
+        DVe = np.where(rho >= 0, s.alpha * self.betap * (1 - s.Ve + s.Vi) * abs(rho), 0.)
+        DVi = np.where(rho >= 0, 0., s.alpha * self.betan * (1 - s.Vi + s.Ve) * abs(rho))
+
+        s.alpha = np.where(rho > 0, s.alpha + -self.thetaE * (abs(rp.lamda - s.Ve + s.Vi) - abs(rp.lamda - VXe + VXi)), s.alpha)
+        s.alpha = np.where(rho < 0, s.alpha + -self.thetaI * (abs(abs(rho) - s.Vi + s.Ve) - abs(abs(rho) - VXi + VXe)), s.alpha)
+
+        s.alpha = np.minimum(np.maximum(s.alpha, 0.05), 1)
+        s.Ve = s.Ve + DVe
+        s.Vi = s.Vi + DVi
+
+        s.assoc = s.Ve - s.Vi
+
 class LePelleyHybrid(AdaptiveType):
     @classmethod
     def parameters(cls) -> list[str]:
@@ -238,6 +345,26 @@ class LePelleyHybrid(AdaptiveType):
         s.Vi += DVi
         s.assoc = s.Ve - s.Vi
 
+    def step_arrays(self, s, rp: RunParameters):
+        rho = rp.lamda - (rp.sigmaE - rp.sigmaI)
+
+        VXe = rp.sigmaE - s.Ve
+        VXi = rp.sigmaI - s.Vi
+
+        DVe = np.where(rho >= 0, s.alpha_mack * self.betap * s.alpha_hall * (1 - s.Ve + s.Vi) * abs(rho), 0.)
+        DVi = np.where(rho >= 0, 0., s.alpha_mack * self.betan * s.alpha_hall * (1 - s.Vi + s.Ve) * abs(rho))
+
+        s.alpha_mack = np.where(rho > 0, s.alpha_mack + -self.thetaE * s.alpha_hall * (abs(rp.lamda - s.Ve + s.Vi) - abs(rp.lamda - VXe + VXi)), s.alpha_mack)
+        s.alpha_mack = np.where(rho < 0, s.alpha_mack + -self.thetaI * (abs(abs(rho) - s.Vi + s.Ve) - abs(abs(rho) - VXi + VXe)), s.alpha_mack)
+
+        s.alpha_hall = self.gamma * abs(rho) + (1 - self.gamma) * s.alpha_hall
+        s.alpha_mack = np.minimum(np.maximum(s.alpha_mack, 0.05), 1)
+        s.alpha_hall = np.minimum(np.maximum(s.alpha_hall, 0.5), 1)
+
+        s.Ve = s.Ve + DVe
+        s.Vi = s.Vi + DVi
+        s.assoc = s.Ve - s.Vi
+
 class RescorlaWagnerExponential(AdaptiveType):
     @classmethod
     def parameters(cls) -> list[str]:
@@ -419,3 +546,7 @@ class MlabHybrid(AdaptiveType):
         s.habituation = s.habituation_0 - s.salience_0 * (1 - s.habituation)
 
         s.assoc = s.assoc + DV 
+
+    # step only assigns new values to the attributes of `s`, so it works with arrays as well.
+    def step_arrays(self, s, rp: RunParameters):
+        self.step(s, rp)
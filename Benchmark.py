@@ -0,0 +1,387 @@
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+from dataclasses import replace
+from pathlib import Path
+
+import numpy as np
+
+from AdaptiveType import AdaptiveType
+from Environment import Environment, Stimulus, StimulusHistory
+from Experiment import Experiment, RWArgs, run_experiments
+from Sampler import Sampler
+
+# Microbenchmarks of the operations that run for every compound lookup and every
+# average of environments.
+
+def micro_environment(size: int) -> Environment:
+    return Environment(
+        s = {
+            chr(ord('A') + c): Stimulus(assoc = c / size, alpha = .1, alpha_mack = .2, alpha_hall = .3, salience = .5, habituation = .99, rho = .2, nu = .25)
+            for c in range(size)
+        }
+    )
+
+def micro_benchmarks(size: int, count: int) -> dict[str, tuple[str, dict]]:
+    env = micro_environment(size)
+    compound = ''.join(sorted(env.s.keys()))
+
+    return {
+        'getitem_simple': ('env["A"]', dict(env = env)),
+        'getitem_compound': ('env[compound]', dict(env = env, compound = compound)),
+        'copy': ('env.copy()', dict(env = env)),
+        'avg': ('Environment.avg(envs)', dict(Environment = Environment, envs = [env.copy() for _ in range(count)])),
+    }
+
+def run_micro(args: argparse.Namespace):
+    print(f'{"benchmark":<20} {"µs/call":>10}')
+    for name, (stmt, env) in micro_benchmarks(args.size, args.count).items():
+        timer = timeit.Timer(stmt, globals = env)
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat = args.repeat, number = number)) / number
+        print(f'{name:<20} {best * 1e6:>10.2f}')
+
+# The benchmark suite runs every model on every bundled experiment, and some
+# synthetic cases that show how the simulator scales with the length of a phase,
+# the amount of CS, and the amount of trials of randomised phases.
+
+def suite_args(adaptive_type: str, num_trials: int, engine: str) -> RWArgs:
+    return RWArgs(
+        adaptive_type = adaptive_type,
+        alphas = {},
+        alpha_macks = {},
+        alpha_halls = {},
+        saliences = {},
+        habituations = {},
+        alpha = .1,
+        alpha_mack = .1,
+        alpha_hall = .1,
+        beta = .3,
+        beta_neg = .2,
+        lamda = 1,
+        gamma = .5,
+        thetaE = .3,
+        thetaI = .1,
+        salience = .5,
+        habituation = .99,
+        rho = .2,
+        nu = .25,
+        kay = 2,
+        window_size = 1,
+        xi_hall = .5,
+        num_trials = num_trials,
+        engine = engine,
+    )
+
+def read_experiments(path: Path) -> list[Experiment]:
+    experiments = []
+    for line in path.read_text().splitlines():
+        if not line.strip():
+            continue
+
+        name, *phase_strs = line.strip().split('|')
+        experiments.append(Experiment(name.strip(), phase_strs))
+
+    return experiments
+
+# Returns the cases of the suite, as a dictionary from their name to the experiments
+# and the arguments used to run them.
+def suite_cases(args: argparse.Namespace) -> dict[str, tuple[list[Experiment], RWArgs]]:
+    cases = {}
+
+    for path in sorted(Path(args.experiments).glob('*.rw')):
+        experiments = read_experiments(path)
+        for adaptive_type in args.models:
+            cases[f'{path.stem} [{adaptive_type}]'] = (experiments, suite_args(adaptive_type, args.num_trials, args.engine))
+
+    def scaled(sizes: list[int]) -> list[int]:
+        return sizes[:(len(sizes) + 1) // 2] if args.quick else sizes
+
+    model = args.scaling_model
+    for length in scaled([10, 100, 1000, 10000, 100000]):
+        cases[f'phase length {length} [{model}]'] = (
+            [Experiment('G', [f'{length // 2}AB+/{length - length // 2}A-'])],
+            suite_args(model, args.num_trials, args.engine),
+        )
+
+    for count in scaled([2, 5, 10, 20]):
+        letters = ''.join(chr(ord('A') + c) for c in range(count))
+        cases[f'cs count {count} [{model}]'] = (
+            [Experiment('G', [f'500{letters}+/' + '/'.join(f'{500 // count}{x}-' for x in letters)])],
+            suite_args(model, args.num_trials, args.engine),
+        )
+
+    for num_trials in scaled([10, 100, 1000, 10000]):
+        cases[f'num trials {num_trials} [{model}]'] = (
+            [Experiment('G', ['rand/50AB+/50A-'])],
+            suite_args(model, num_trials, args.engine),
+        )
+
+    return cases
+
+# Amount of trials simulated by a case, counting every permutation of randomised phases.
+def count_trials(experiments: list[Experiment], args: RWArgs) -> int:
+    return sum(
+        len(phase) * (args.num_trials if phase.rand else 1)
+        for experiment in experiments
+        for phase in experiment.phases
+    )
+
+# Run a single case, returning its best wall time out of `repeat` runs, and the
+# peak memory allocated in a separate run (since tracing memory slows down the run).
+def run_case(experiments: list[Experiment], args: RWArgs, repeat: int) -> dict[str, float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run_experiments(experiments, args)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    run_experiments(experiments, args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    trials = count_trials(experiments, args)
+    return dict(
+        wall_time = min(times),
+        trials = trials,
+        trials_per_second = trials / min(times),
+        peak_memory = peak,
+    )
+
+def run_suite(args: argparse.Namespace):
+    results = dict(
+        meta = dict(
+            python = platform.python_version(),
+            numpy = np.__version__,
+            platform = platform.platform(),
+            engine = args.engine,
+        ),
+        cases = {},
+    )
+
+    for name, (experiments, run_args) in suite_cases(args).items():
+        if args.filter is not None and args.filter not in name:
+            continue
+
+        results['cases'][name] = case = run_case(experiments, run_args, args.repeat)
+        print(f'{name:<50} {case["wall_time"]:>10.4f}s {case["trials_per_second"]:>12.0f} trials/s {case["peak_memory"] / 2**20:>9.2f} MiB', file = sys.stderr)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 2)
+
+# Compare two results files, printing every case and flagging the ones where the
+# wall time or the peak memory grew more than the threshold.
+def run_compare(args: argparse.Namespace):
+    with open(args.baseline) as f:
+        baseline = json.load(f)['cases']
+    with open(args.results) as f:
+        results = json.load(f)['cases']
+
+    regressions = []
+    print(f'{"case":<50} {"time":>8} {"memory":>8}')
+    for name, case in results.items():
+        if name not in baseline:
+            print(f'{name:<50} {"new":>8} {"new":>8}')
+            continue
+
+        time_ratio = case['wall_time'] / baseline[name]['wall_time']
+        memory_ratio = case['peak_memory'] / max(baseline[name]['peak_memory'], 1)
+
+        flag = ''
+        if time_ratio > 1 + args.threshold or memory_ratio > 1 + args.memory_threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+
+        print(f'{name:<50} {time_ratio:>7.2f}x {memory_ratio:>7.2f}x{flag}')
+
+    if regressions:
+        print(f'{len(regressions)} regressions out of {len(results)} cases.')
+        sys.exit(1)
+
+# The start-up benchmark measures how long a new interpreter takes to import the
+# simulator, and checks that the compute path doesn't import any plotting library.
+
+plotting_modules = ['matplotlib', 'seaborn', 'PyQt6']
+
+startup_script = '''
+import sys, time, json
+start = time.perf_counter()
+import {module}
+print(json.dumps(dict(time = time.perf_counter() - start, plotting = [m for m in {plotting!r} if m in sys.modules])))
+'''
+
+def run_startup(args: argparse.Namespace):
+    failed = False
+    print(f'{"module":<20} {"import":>10} {"process":>10}  plotting imports')
+    for module in args.modules:
+        script = startup_script.format(module = module, plotting = plotting_modules)
+
+        import_times, process_times = [], []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, '-c', script], cwd = Path(__file__).parent, capture_output = True, text = True, check = True).stdout
+            process_times.append(time.perf_counter() - start)
+
+            result = json.loads(output)
+            import_times.append(result['time'])
+
+        plotting = result['plotting']
+        print(f'{module:<20} {min(import_times):>9.3f}s {min(process_times):>9.3f}s  {" ".join(plotting) or "none"}')
+
+        if plotting or min(process_times) > args.threshold:
+            failed = True
+
+    if failed:
+        print(f'Some modules imported plotting libraries or took more than {args.threshold}s to start.')
+        sys.exit(1)
+
+# The checkpoint check runs each case twice with a ResultCache: once with the
+# first arguments and experiment, and once more after changing them, resuming from
+# the checkpoints of the first run. Resumed results must be identical to the ones
+# of running the changed group from scratch.
+
+def checkpoint_cases(adaptive_type: str, engine: str) -> dict[str, tuple[Experiment, RWArgs, Experiment, RWArgs]]:
+    args = replace(suite_args(adaptive_type, 20, engine), seed = 0, alphas = {'X': .1})
+    first = Experiment('G', ['10A+', '10X+', 'rand/5AX+/5A-'])
+
+    return {
+        'later phase': (first, args, Experiment('G', ['10A+', '10X-', 'rand/5AX+/5A-']), args),
+        'alpha of a CS of a later phase': (first, args, first, replace(args, alphas = {'X': .9})),
+        'salience of a CS of a later phase': (first, args, first, replace(args, saliences = {'X': .3})),
+        'new CS in a later phase': (first, args, Experiment('G', ['10A+', '10Y+', 'rand/5AX+/5A-']), args),
+    }
+
+def run_checkpoints(args: argparse.Namespace):
+    from Cache import ResultCache
+
+    failed = []
+    for adaptive_type in args.models:
+        for name, (first, first_args, second, second_args) in checkpoint_cases(adaptive_type, args.engine).items():
+            cache = ResultCache()
+            _, checkpoints = first.run_from_checkpoints(first_args, cache.checkpoints(first, first_args))
+            cache.put_checkpoints(first, first_args, checkpoints)
+
+            resumed, _ = second.run_from_checkpoints(second_args, cache.checkpoints(second, second_args))
+            fresh = second.run_all_phases(second_args)
+
+            same = len(resumed) == len(fresh) and all(
+                a.keys() == b.keys() and all(np.array_equal(a[k].values, b[k].values) for k in a)
+                for a, b in zip(resumed, fresh)
+            )
+            print(f'{adaptive_type:<24} {name:<36} {"ok" if same else "MISMATCH"}')
+            if not same:
+                failed.append((adaptive_type, name))
+
+    if failed:
+        print(f'{len(failed)} cases resumed from checkpoints differ from running them from scratch.')
+        sys.exit(1)
+
+# The sampling benchmark measures the precision of the average of a randomised phase
+# with each sampler, as the root mean square error of the associative strength of
+# its CS against a reference run with many random permutations, over several seeds.
+
+# Mean squared error of some results against the reference. The reference is an
+# average too, so its own squared error (its variance over the amount of its
+# permutations) is subtracted.
+def sampling_error(results: dict[str, StimulusHistory], reference: dict[str, StimulusHistory]) -> float:
+    errors = []
+    for key, hist in reference.items():
+        if hist.variance is not None:
+            errors.append(np.mean((results[key].assoc - hist.assoc) ** 2 - hist.variance.assoc / hist.runs))
+
+    return float(np.mean(errors))
+
+def run_sampling(args: argparse.Namespace):
+    experiment = Experiment('G', [args.phase])
+    run_args = replace(suite_args(args.model, args.reference, args.engine), seed = args.repeat)
+    [reference] = experiment.run_all_phases(run_args)
+
+    errors = {}
+    def error(sampler: str, num_trials: int) -> float:
+        if (sampler, num_trials) not in errors:
+            squared = [
+                sampling_error(experiment.run_all_phases(replace(run_args, sampler = sampler, num_trials = num_trials, seed = seed))[0], reference)
+                for seed in range(args.repeat)
+            ]
+            errors[sampler, num_trials] = float(np.sqrt(max(np.mean(squared), 0.)))
+
+        return errors[sampler, num_trials]
+
+    # Amount of permutations each sampler needs to be as precise as `target` random ones.
+    target = error('random', args.target)
+
+    print(f'{"sampler":<12}' + ''.join(f'{n:>10}' for n in args.num_trials) + f'{"needed":>10}')
+    for sampler in args.samplers:
+        row = [error(sampler, n) for n in args.num_trials]
+        needed = next((str(n) for n, e in zip(args.num_trials, row) if e <= target), f'>{args.num_trials[-1]}')
+        print(f'{sampler:<12}' + ''.join(f'{e:>10.5f}' for e in row) + f'{needed:>10}')
+
+    print(f'Error of {args.target} random permutations: {target:.5f}')
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description = 'Benchmarks for the PALMS simulator.')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    micro = subparsers.add_parser('micro', help = 'Microbenchmarks of Environment and Stimulus operations.')
+    micro.add_argument('--size', type = int, default = 4, help = 'Amount of CS in the environment.')
+    micro.add_argument('--count', type = int, default = 100, help = 'Amount of environments averaged by Environment.avg.')
+    micro.add_argument('--repeat', type = int, default = 5, help = 'Amount of repetitions; the best one is reported.')
+    micro.set_defaults(func = run_micro)
+
+    suite = subparsers.add_parser('suite', help = 'Run every model on every experiment, and the synthetic scaling cases.')
+    suite.add_argument('--output', default = 'benchmark.json', help = 'JSON file where the results are written.')
+    suite.add_argument('--experiments', default = 'Experiments', help = 'Directory with the experiment files.')
+    suite.add_argument('--models', nargs = '*', choices = AdaptiveType.types().keys(), default = list(AdaptiveType.types().keys()), help = 'Models run on the experiment files.')
+    suite.add_argument('--scaling-model', choices = AdaptiveType.types().keys(), default = 'Rescorla Wagner', help = 'Model used in the synthetic scaling cases.')
+    suite.add_argument('--num-trials', type = int, default = 100, help = 'Amount of trials done in randomised phases, except in the scaling cases that change it.')
+    suite.add_argument('--engine', choices = ['array', 'object'], default = 'array', help = 'Simulation engine.')
+    suite.add_argument('--repeat', type = int, default = 3, help = 'Amount of repetitions of each case; the best one is reported.')
+    suite.add_argument('--filter', help = 'Only run the cases whose name contains this string.')
+    suite.add_argument('--quick', action = 'store_true', help = 'Only run the smaller half of each scaling case.')
+    suite.set_defaults(func = run_suite)
+
+    compare = subparsers.add_parser('compare', help = 'Compare results of the suite against a baseline, and exit with an error if there are regressions.')
+    compare.add_argument('baseline', help = 'JSON file with the baseline results.')
+    compare.add_argument('results', help = 'JSON file with the new results.')
+    compare.add_argument('--threshold', type = float, default = .2, help = 'Maximum allowed relative increase of wall time.')
+    compare.add_argument('--memory-threshold', type = float, default = .2, help = 'Maximum allowed relative increase of peak memory.')
+    compare.set_defaults(func = run_compare)
+
+    startup = subparsers.add_parser('startup', help = 'Time importing the simulator in a new interpreter, and exit with an error if it is slow or imports plotting libraries.')
+    startup.add_argument('--modules', nargs = '*', default = ['Simulator', 'Experiment', 'Sweep', 'Fit'], help = 'Modules to import.')
+    startup.add_argument('--repeat', type = int, default = 5, help = 'Amount of repetitions; the best one is reported.')
+    startup.add_argument('--threshold', type = float, default = .5, help = 'Maximum allowed start-up time of the whole process, in seconds.')
+    startup.set_defaults(func = run_startup)
+
+    checkpoints = subparsers.add_parser('checkpoints', help = 'Check that groups resumed from cached checkpoints give the same results as running them from scratch, and exit with an error if they do not.')
+    checkpoints.add_argument('--models', nargs = '*', choices = AdaptiveType.types().keys(), default = list(AdaptiveType.types().keys()), help = 'Models to check.')
+    checkpoints.add_argument('--engine', choices = ['array', 'object'], default = 'array', help = 'Simulation engine.')
+    checkpoints.set_defaults(func = run_checkpoints)
+
+    sampling = subparsers.add_parser('sampling', help = 'Compare the precision of the samplers of randomised phases against the amount of permutations.')
+    sampling.add_argument('--phase', default = 'rand/100A+/100AX-', help = 'Randomised phase to run.')
+    sampling.add_argument('--model', choices = AdaptiveType.types().keys(), default = 'Rescorla Wagner', help = 'Model used to run the phase.')
+    sampling.add_argument('--engine', choices = ['array', 'object'], default = 'array', help = 'Simulation engine.')
+    sampling.add_argument('--samplers', nargs = '*', choices = Sampler.types().keys(), default = list(Sampler.types().keys()), help = 'Samplers to compare.')
+    sampling.add_argument('--num-trials', nargs = '*', type = int, default = [10, 20, 50, 100, 200, 500, 1000], help = 'Amounts of permutations to measure.')
+    sampling.add_argument('--target', type = int, default = 1000, help = 'For each sampler, find the amount of permutations as precise as this many random ones.')
+    sampling.add_argument('--reference', type = int, default = 20000, help = 'Amount of random permutations of the reference.')
+    sampling.add_argument('--repeat', type = int, default = 20, help = 'Amount of seeds each measurement is averaged over.')
+    sampling.set_defaults(func = run_sampling)
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
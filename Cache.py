@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import fields
+from typing import Hashable
+
+from Environment import StimulusHistory
+from Experiment import Checkpoint, Experiment, RWArgs
+
+Results = list[dict[str, StimulusHistory]]
+
+# ResultCache keeps the results of running single groups, so that they don't have to
+# be run again when nothing that affects them changes. When the results use more
+# than `max_bytes`, the least recently used ones are removed.
+#
+# It also keeps a checkpoint after every phase of a group, so that when a phase
+# changes, the group can be run again from the checkpoint before that phase.
+class ResultCache:
+    # Fields of RWArgs that only affect how the results are shown.
+    display_fields = {'plot_phase', 'plot_experiments', 'plot_stimuli', 'plot_alpha', 'plot_macknhall', 'title_suffix', 'savefig'}
+
+    max_bytes: int
+    size: int
+    entries: OrderedDict[Hashable, tuple[Results | Checkpoint, int]]
+
+    hits: int
+    misses: int
+
+    def __init__(self, max_bytes: int = 256 * 2**20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Key of the results of a group: its name, its phases, and the value of every
+    # argument that affects it. Per-CS values only include the CS of this group.
+    # If `phases` is set, this is the key of only the first `phases` phases.
+    @classmethod
+    def key(cls, experiment: Experiment, args: RWArgs, phases: None | int = None) -> Hashable:
+        css = set.union(set(), *[phase.cs() for phase in experiment.phases[:phases]])
+
+        values = []
+        for field in fields(RWArgs):
+            if field.name in cls.display_fields:
+                continue
+
+            value = getattr(args, field.name)
+            if isinstance(value, dict):
+                value = tuple(sorted((k, v) for k, v in value.items() if k in css))
+
+            values.append((field.name, value))
+
+        return (experiment.name, tuple(phase.phase_str for phase in experiment.phases[:phases]), tuple(values))
+
+    # Approximate amount of memory used by the histories of a phase.
+    @staticmethod
+    def history_size(phase: dict[str, StimulusHistory]) -> int:
+        size = 0
+        for hist in phase.values():
+            size += hist.values.nbytes + hist.windows.nbytes + hist.window_lens.nbytes
+            if hist.variance is not None:
+                size += hist.variance.values.nbytes
+
+        return size
+
+    # Approximate amount of memory used by some results or a checkpoint.
+    @classmethod
+    def result_size(cls, results: Results | Checkpoint) -> int:
+        if isinstance(results, tuple):
+            return cls.history_size(results[0])
+
+        return sum(cls.history_size(phase) for phase in results)
+
+    # Returns the longest list of consecutive checkpoints of the first phases of a group.
+    def checkpoints(self, experiment: Experiment, args: RWArgs) -> list[Checkpoint]:
+        checkpoints = []
+        for phases in range(1, len(experiment.phases) + 1):
+            key = ('checkpoint', self.key(experiment, args, phases))
+            if key not in self.entries:
+                break
+
+            self.entries.move_to_end(key)
+            checkpoints.append(self.entries[key][0])
+
+        return checkpoints
+
+    def put_checkpoints(self, experiment: Experiment, args: RWArgs, checkpoints: list[Checkpoint]):
+        for phases, checkpoint in enumerate(checkpoints, start = 1):
+            self.put(('checkpoint', self.key(experiment, args, phases)), checkpoint)
+
+    def get(self, key: Hashable) -> None | Results:
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key: Hashable, results: Results | Checkpoint):
+        size = self.result_size(results)
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+
+        self.entries[key] = (results, size)
+        self.size += size
+
+        while self.size > self.max_bytes:
+            _, (_, removed) = self.entries.popitem(last = False)
+            self.size -= removed
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
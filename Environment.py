@@ -1,9 +1,95 @@
 from __future__ import annotations
-from collections import deque, defaultdict
+from collections import defaultdict
 from functools import reduce
 from itertools import combinations
 
+import numpy as np
+
+# Window is a fixed-capacity ring buffer with the last values of a sliding window.
+class Window:
+    __slots__ = ('values', 'start', 'size')
+
+    values: list[float]
+    start: int
+    size: int
+
+    def __init__(self, capacity: int = 0, values = ()):
+        self.values = [0.] * capacity
+        self.start = 0
+        self.size = 0
+
+        for value in values:
+            self.append(value)
+
+    # Create a window from its fields, without copying them.
+    @classmethod
+    def fromValues(cls, values: list[float], start: int, size: int) -> Window:
+        window = cls.__new__(cls)
+        window.values = values
+        window.start = start
+        window.size = size
+        return window
+
+    @property
+    def capacity(self) -> int:
+        return len(self.values)
+
+    # Add a value to the window, removing the oldest one if it's full.
+    def append(self, value: float):
+        if self.size < len(self.values):
+            self.values[(self.start + self.size) % len(self.values)] = value
+            self.size += 1
+        elif self.values:
+            self.values[self.start] = value
+            self.start = (self.start + 1) % len(self.values)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self):
+        for e in range(self.size):
+            yield self.values[(self.start + e) % len(self.values)]
+
+    def sum(self) -> float:
+        return sum(self)
+
+    # Combine two windows element by element, aligning them by their newest value
+    # and treating missing values in the shorter one as 0.
+    def join(self, other: Window, op) -> Window:
+        capacity = max(len(self.values), len(other.values))
+        size = max(self.size, other.size)
+        this = [0.] * (size - self.size) + list(self)
+        that = [0.] * (size - other.size) + list(other)
+        return Window.fromValues(list(map(op, this, that)) + [0.] * (capacity - size), 0, size)
+
+    def __truediv__(self, quot: int) -> Window:
+        return Window.fromValues([x / quot for x in self.values], self.start, self.size)
+
+    def copy(self) -> Window:
+        return Window.fromValues(self.values.copy(), self.start, self.size)
+
 class Stimulus:
+    # Numeric fields of a stimulus, in the order used by Kernel and StimulusAccumulator.
+    fields = (
+        'assoc',
+        'Ve',
+        'Vi',
+        'alpha',
+        'alpha_mack',
+        'alpha_hall',
+        'salience',
+        'habituation',
+        'rho',
+        'nu',
+        'delta_ma_hall',
+        'alpha_mack_0',
+        'alpha_hall_0',
+        'salience_0',
+        'habituation_0',
+    )
+
+    __slots__ = fields + ('window',)
+
     assoc: float
 
     Ve: float
@@ -19,7 +105,7 @@ class Stimulus:
     rho: float
     nu: float
 
-    window: deque[float]
+    window: Window
     delta_ma_hall: float
 
     alpha_mack_0: float
@@ -49,65 +135,317 @@ class Stimulus:
         self.habituation_0 = habituation_0 or self.habituation
 
         if window is None:
-            window = deque([])
+            window = Window()
 
         self.window = window.copy()
         self.delta_ma_hall = delta_ma_hall
 
-    def join(self, other: Stimulus, op) -> Stimulus:
-        ret = {}
-        for prop in self.__dict__.keys():
-            this = getattr(self, prop)
-            that = getattr(other, prop)
-
-            if type(this) is float or type(this) is int:
-                ret[prop] = op(this, that)
-            elif type(this) is deque:
-                size = max(len(this), len(that))
-                this = deque([0] * (size - len(this))) + this
-                that = deque([0] * (size - len(that))) + that
-                ret[prop] = deque([op(a, b) for a, b in zip(this, that)])
-            else:
-                raise ValueError(f'Unknown type {type(this)} for {prop}, which is equal to {this} and {that}')
-
-        return Stimulus(**ret)
+    # Create a stimulus from its values, without going through the defaults of __init__.
+    @classmethod
+    def fromValues(cls, assoc: float, Ve: float, Vi: float, alpha: float, alpha_mack: float, alpha_hall: float, salience: float, habituation: float, rho: float, nu: float, delta_ma_hall: float, alpha_mack_0: float, alpha_hall_0: float, salience_0: float, habituation_0: float, window: Window) -> Stimulus:
+        s = cls.__new__(cls)
+        s.assoc = assoc
+        s.Ve = Ve
+        s.Vi = Vi
+        s.alpha = alpha
+        s.alpha_mack = alpha_mack
+        s.alpha_hall = alpha_hall
+        s.salience = salience
+        s.habituation = habituation
+        s.rho = rho
+        s.nu = nu
+        s.delta_ma_hall = delta_ma_hall
+        s.alpha_mack_0 = alpha_mack_0
+        s.alpha_hall_0 = alpha_hall_0
+        s.salience_0 = salience_0
+        s.habituation_0 = habituation_0
+        s.window = window
+        return s
 
     def __add__(self, other: Stimulus) -> Stimulus:
-        return self.join(other, lambda a, b: a + b)
+        return Stimulus.fromValues(
+            self.assoc + other.assoc,
+            self.Ve + other.Ve,
+            self.Vi + other.Vi,
+            self.alpha + other.alpha,
+            self.alpha_mack + other.alpha_mack,
+            self.alpha_hall + other.alpha_hall,
+            self.salience + other.salience,
+            self.habituation + other.habituation,
+            self.rho + other.rho,
+            self.nu + other.nu,
+            self.delta_ma_hall + other.delta_ma_hall,
+            self.alpha_mack_0 + other.alpha_mack_0,
+            self.alpha_hall_0 + other.alpha_hall_0,
+            self.salience_0 + other.salience_0,
+            self.habituation_0 + other.habituation_0,
+            self.window.join(other.window, lambda a, b: a + b),
+        )
 
     def __truediv__(self, quot: int) -> Stimulus:
-        ret = {}
-        for prop in self.__dict__.keys():
-            this = getattr(self, prop)
+        return Stimulus.fromValues(
+            self.assoc / quot,
+            self.Ve / quot,
+            self.Vi / quot,
+            self.alpha / quot,
+            self.alpha_mack / quot,
+            self.alpha_hall / quot,
+            self.salience / quot,
+            self.habituation / quot,
+            self.rho / quot,
+            self.nu / quot,
+            self.delta_ma_hall / quot,
+            self.alpha_mack_0 / quot,
+            self.alpha_hall_0 / quot,
+            self.salience_0 / quot,
+            self.habituation_0 / quot,
+            self.window / quot,
+        )
 
-            if type(this) is float or type(this) is int:
-                ret[prop] = this / quot
-            elif type(this) is deque:
-                ret[prop] = deque([a / quot for a in this]) # type: ignore
-            else:
-                raise ValueError(f'Unknown type {type(this)} for {prop}, which is equal to {this}')
+    def copy(self) -> Stimulus:
+        return Stimulus.fromValues(
+            self.assoc,
+            self.Ve,
+            self.Vi,
+            self.alpha,
+            self.alpha_mack,
+            self.alpha_hall,
+            self.salience,
+            self.habituation,
+            self.rho,
+            self.nu,
+            self.delta_ma_hall,
+            self.alpha_mack_0,
+            self.alpha_hall_0,
+            self.salience_0,
+            self.habituation_0,
+            self.window.copy(),
+        )
+
+# StimulusHistory keeps the values of a single CS at every step as columns:
+# values[f, n] is the value of field `Stimulus.fields[f]` at step n.
+# Accessing a field (for example, `hist.assoc`) returns a view of its column,
+# without copying it.
+class StimulusHistory:
+    index = {field: f for f, field in enumerate(Stimulus.fields)}
+
+    values: np.ndarray
+    size: int
+
+    # Sliding windows are kept right-aligned: windows[n, -window_lens[n]:] is the
+    # window at step n, and the rest of the values are zero.
+    windows: np.ndarray
+    window_lens: np.ndarray
+
+    # When this history is the average of several runs (for example, in a randomised
+    # phase), this contains the variance of each field at each step, and `runs` the
+    # amount of runs that were averaged.
+    variance: None | StimulusHistory
+    runs: None | int
+
+    def __init__(self, capacity: int = 16):
+        self.values = np.empty((len(Stimulus.fields), capacity))
+        self.size = 0
+        self.windows = np.zeros((capacity, 0))
+        self.window_lens = np.zeros(capacity, dtype = int)
+        self.variance = None
+        self.runs = None
+
+    # Create a history from an array of shape (fields, steps) without copying it.
+    @classmethod
+    def fromArrays(cls, values: np.ndarray) -> StimulusHistory:
+        hist = cls(capacity = 0)
+        hist.values = values
+        hist.size = values.shape[1]
+        hist.windows = np.zeros((hist.size, 0))
+        hist.window_lens = np.zeros(hist.size, dtype = int)
+        return hist
+
+    # Create the history of a compound CS, whose value at every step is the sum of
+    # the values of its parts. It is as long as the shortest of them.
+    @classmethod
+    def sum(cls, histories: list[StimulusHistory]) -> StimulusHistory:
+        size = min(len(h) for h in histories)
+        window_size = max(h.windows.shape[1] for h in histories)
 
-        return Stimulus(**ret)
+        hist = cls(capacity = 0)
+        hist.values = histories[0].values[:, :size].copy()
+        hist.size = size
+        hist.windows = np.zeros((size, window_size))
+        hist.window_lens = np.zeros(size, dtype = int)
 
-    def copy(self) -> Stimulus:
-        return Stimulus(**self.__dict__)
+        for e, h in enumerate(histories):
+            if e > 0:
+                hist.values += h.values[:, :size]
 
-class StimulusHistory:
-    hist: list[Stimulus]
+            # Windows are right-aligned, so adding them aligns their newest values.
+            if h.windows.shape[1] > 0:
+                hist.windows[:, -h.windows.shape[1]:] += h.windows[:size]
+            hist.window_lens = np.maximum(hist.window_lens, h.window_lens[:size])
+
+        return hist
 
-    def __init__(self):
-        self.hist = []
+    def grow(self, capacity: int, window_size: int):
+        values = np.empty((len(Stimulus.fields), capacity))
+        values[:, :self.size] = self.values[:, :self.size]
+
+        windows = np.zeros((capacity, window_size))
+        if self.windows.shape[1] > 0:
+            windows[:self.size, -self.windows.shape[1]:] = self.windows[:self.size]
+
+        window_lens = np.zeros(capacity, dtype = int)
+        window_lens[:self.size] = self.window_lens[:self.size]
+
+        self.values, self.windows, self.window_lens = values, windows, window_lens
 
     def add(self, ind: Stimulus):
-        self.hist.append(ind.copy())
+        window_size = max(len(ind.window), self.windows.shape[1])
+        if self.size == self.values.shape[1] or window_size > self.windows.shape[1]:
+            self.grow(max(2 * self.size, 16), window_size)
+
+        self.values[:, self.size] = [getattr(ind, field) for field in Stimulus.fields]
+        if ind.window:
+            self.windows[self.size, -len(ind.window):] = list(ind.window)
+        self.window_lens[self.size] = len(ind.window)
+        self.size += 1
+
+    # Add `len(window_lens)` steps at once, which have the same values as `ind` except
+    # for the fields in `columns` and the windows, which are right-aligned.
+    def extend(self, ind: Stimulus, columns: dict[str, np.ndarray], windows: np.ndarray, window_lens: np.ndarray):
+        n = len(window_lens)
+        window_size = max(windows.shape[1], self.windows.shape[1])
+        if self.size + n > self.values.shape[1] or window_size > self.windows.shape[1]:
+            self.grow(max(2 * self.size, self.size + n, 16), window_size)
+
+        self.values[:, self.size:self.size + n] = np.array([getattr(ind, field) for field in Stimulus.fields])[:, None]
+        for field, column in columns.items():
+            self.values[StimulusHistory.index[field], self.size:self.size + n] = column
+
+        if windows.shape[1] > 0:
+            self.windows[self.size:self.size + n, -windows.shape[1]:] = windows
+        self.window_lens[self.size:self.size + n] = window_lens
+        self.size += n
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, n: int) -> Stimulus:
+        window = self.windows[n, self.windows.shape[1] - self.window_lens[n]:]
+        return Stimulus.fromValues(*self.values[:, n].tolist(), window = Window(self.windows.shape[1], window.tolist()))
 
     def __getattr__(self, key):
-        return [getattr(p, key) for p in self.hist]
+        if key not in StimulusHistory.index:
+            raise AttributeError(key)
+
+        return self.values[StimulusHistory.index[key], :self.size]
 
     @classmethod
     def emptydict(cls) -> dict[str, StimulusHistory]:
         return defaultdict(lambda: StimulusHistory())
 
+# StimulusAccumulator keeps the running mean and variance of the histories and
+# final strengths of many runs of the same phase, using Welford's algorithm.
+# Runs are added one at a time, so its memory does not depend on the number of runs.
+class StimulusAccumulator:
+    count: int
+
+    # When runs are only independent in groups of `group_size` consecutive runs, the
+    # means of the histories of every complete group are kept in `groups`, and
+    # `group_sum` has the sum of the histories of the current one.
+    group_size: int
+    groups: None | StimulusAccumulator
+    group_sum: dict[str, np.ndarray]
+
+    # mean[cs] and m2[cs] have shape (fields, steps).
+    mean: dict[str, np.ndarray]
+    m2: dict[str, np.ndarray]
+
+    # final[cs] has shape (fields,) and window[cs] has shape (window length,).
+    final: dict[str, np.ndarray]
+    window: dict[str, np.ndarray]
+
+    def __init__(self, group_size: int = 1):
+        self.count = 0
+        self.mean = {}
+        self.m2 = {}
+        self.final = {}
+        self.window = {}
+        self.group_size = group_size
+        self.groups = None if group_size == 1 else StimulusAccumulator()
+        self.group_sum = {}
+
+    # Add a single run, where `hist[cs]` is an array of shape (fields, steps) with the
+    # history of each CS, `final[cs]` has the final value of each field, and
+    # `window[cs]` has the final sliding window of each CS.
+    # Every run of the same phase has the same CS with the same history lengths.
+    def addArrays(self, hist: dict[str, np.ndarray], final: dict[str, np.ndarray], window: dict[str, np.ndarray]):
+        self.count += 1
+
+        if self.groups is not None:
+            self.group_sum = {cs: self.group_sum[cs] + x if cs in self.group_sum else x.copy() for cs, x in hist.items()}
+            if self.count % self.group_size == 0:
+                self.groups.addArrays({cs: x / self.group_size for cs, x in self.group_sum.items()}, {}, {})
+                self.group_sum = {}
+
+        if self.count == 1:
+            self.mean = {cs: x.copy() for cs, x in hist.items()}
+            self.m2 = {cs: np.zeros_like(x) for cs, x in hist.items()}
+            self.final = {cs: x.copy() for cs, x in final.items()}
+            self.window = {cs: x.copy() for cs, x in window.items()}
+            return
+
+        for cs, x in hist.items():
+            delta = x - self.mean[cs]
+            self.mean[cs] += delta / self.count
+            self.m2[cs] += delta * (x - self.mean[cs])
+
+        for cs, x in final.items():
+            self.final[cs] += (x - self.final[cs]) / self.count
+
+        for cs, x in window.items():
+            self.window[cs] += (x - self.window[cs]) / self.count
+
+    # Add a single run from the histories returned by Group.runPhase and its final environment.
+    def add(self, hist: dict[str, StimulusHistory], final: Environment):
+        self.addArrays(
+            {cs: h.values[:, :len(h)] for cs, h in hist.items()},
+            {cs: np.array([getattr(s, field) for field in Stimulus.fields], dtype = float) for cs, s in final.s.items()},
+            {cs: np.array(list(s.window), dtype = float) for cs, s in final.s.items()},
+        )
+
+    # Average history of every CS, where the variance of each one contains the
+    # sample variance of each field at each step.
+    def histories(self) -> dict[str, StimulusHistory]:
+        hist = StimulusHistory.emptydict()
+        for cs, mean in self.mean.items():
+            hist[cs] = StimulusHistory.fromArrays(mean.copy())
+            hist[cs].variance = StimulusHistory.fromArrays(self.m2[cs] / max(self.count - 1, 1))
+            hist[cs].runs = self.count
+
+        return hist
+
+    # Largest standard error of the mean of a field, over every CS and step. It is
+    # infinite until there are at least two independent runs or groups.
+    def standard_error(self, field: str = 'assoc') -> float:
+        if self.groups is not None:
+            return self.groups.standard_error(field)
+
+        if self.count < 2:
+            return float('inf')
+
+        f = StimulusHistory.index[field]
+        return max((float(np.sqrt(m2[f].max() / (self.count - 1) / self.count)) for m2 in self.m2.values() if m2.shape[1] > 0), default = 0.)
+
+    # Average final environment.
+    def environment(self) -> Environment:
+        s = {}
+        for cs, final in self.final.items():
+            # Set the values directly, since the constructor replaces falsy alphas.
+            window = Window(len(self.window[cs]), self.window[cs].tolist())
+            s[cs] = Stimulus.fromValues(*final.tolist(), window = window)
+
+        return Environment(s = s)
+
 class Environment:
     cs: set[str]
     s: dict[str, Stimulus]
@@ -130,13 +468,13 @@ class Environment:
     # fromHistories "transposes" a several histories of single CSs into a single list of many CSs.
     @staticmethod
     def fromHistories(histories: dict[str, StimulusHistory]) -> list[Environment]:
-        longest = max((len(x.hist) for x in histories.values()), default = 0)
+        longest = max((len(x) for x in histories.values()), default = 0)
         return [
             Environment(
                 s = {
-                    cs: h.hist[i]
+                    cs: h[i]
                     for cs, h in histories.items()
-                    if len(h.hist) > i
+                    if len(h) > i
                 }
             )
             for i in range(longest)
@@ -1,16 +1,25 @@
 from __future__ import annotations
 
-import random
 import re
+from concurrent.futures import Executor
 from dataclasses import dataclass
-from itertools import combinations
+from collections.abc import Iterator
+from itertools import combinations, repeat
 
-from Group import Group
+import numpy as np
+
+from Group import Group, Block
+from Sampler import Sampler
 from Environment import Environment, StimulusHistory
 
+# Checkpoint is the result of running a single phase of a group: the histories of
+# that phase and the state of the group after it.
+Checkpoint = tuple[dict[str, StimulusHistory], Environment]
+
 class Phase:
-    # elems contains a list of ([CS], US) of an experiment.
-    elems: list[tuple[str, str]]
+    # blocks contains a list of ([CS], US, count) of an experiment, where each block
+    # represents `count` identical consecutive trials.
+    blocks: list[Block]
 
     # Whether this phase should be randomised.
     rand: bool
@@ -23,21 +32,23 @@ class Phase:
 
     # Return the set of single (one-character) CS.
     def cs(self) -> set[str]:
-        if not self.elems:
-            return set()
-        return set.union(*[set(x[0]) for x in self.elems])
+        return {x for cs, _, _ in self.blocks for x in cs}
 
     # Return the list of applicable compound CS.
     # self.compound_cs() ⊇ self.cs()
     def compound_cs(self) -> set[str]:
-        compound = {''.join(sorted(cs)) for cs, _ in self.elems}
+        compound = {''.join(sorted(cs)) for cs, _, _ in self.blocks}
         return self.cs() | compound
 
+    # Amount of trials in this phase.
+    def __len__(self) -> int:
+        return sum(count for _, _, count in self.blocks)
+
     def __init__(self, phase_str: str):
         self.phase_str = phase_str
         self.rand = False
         self.lamda = None
-        self.elems = []
+        self.blocks = []
 
         for part in self.phase_str.strip().split('/'):
             if part == 'rand':
@@ -47,7 +58,13 @@ class Phase:
             elif (match := re.fullmatch(r'([0-9]*)([A-Za-zÑñ]+)([+-]?)', part)) is not None:
                 num, cs, sign = match.groups()
                 cs = cs.upper()
-                self.elems += int(num or '1') * [(cs, sign or '+')]
+                count, sign = int(num or '1'), sign or '+'
+                if count == 0:
+                    continue
+
+                if self.blocks and self.blocks[-1][:2] == (cs, sign):
+                    count += self.blocks.pop()[2]
+                self.blocks.append((cs, sign, count))
             elif not part.strip():
                 continue
             else:
@@ -94,6 +111,19 @@ class RWArgs:
     title_suffix: None | str = None
     savefig: None | str = None
 
+    engine: str = 'array'
+
+    # Seed of the randomised phases; None uses fresh entropy on every run.
+    seed: None | int = None
+
+    # If set, randomised phases stop once the standard error of the average associative
+    # strength is below this at every step, and num_trials is the maximum amount of
+    # permutations.
+    tolerance: None | float = None
+
+    # Name of the Sampler of the permutations of randomised phases.
+    sampler: str = 'random'
+
 class Experiment:
     name: str
     phases: list[Phase]
@@ -104,7 +134,7 @@ class Experiment:
 
     def run_all_phases(self, args: RWArgs) -> list[dict[str, StimulusHistory]]:
         group = self.initial_group(args)
-        results = self.run_group_experiments(group, args.num_trials)
+        results = self.run_group_experiments(group, args)
         strengths = self.group_results(results, args)
 
         return strengths
@@ -136,46 +166,85 @@ class Experiment:
             adaptive_type = args.adaptive_type,
             window_size = args.window_size,
             xi_hall = args.xi_hall,
+            engine = args.engine,
         )
 
         return g
 
-    def run_group_experiments(self, g: Group, num_trials: int) -> list[list[Environment]]:
-        results = []
+    def run_group_experiments(self, g: Group, args: RWArgs) -> list[dict[str, StimulusHistory]]:
+        return [self.run_phase(g, phase_num, args) for phase_num in range(len(self.phases))]
 
-        for trial, phase in enumerate(self.phases):
-            if not phase.rand:
-                strength_hist = g.runPhase(phase.elems, phase.lamda)
-                results.append(strength_hist)
-            else:
-                initial_strengths = g.s.copy()
-                final_strengths = []
-                hist = []
+    def run_phase(self, g: Group, phase_num: int, args: RWArgs) -> dict[str, StimulusHistory]:
+        phase = self.phases[phase_num]
+        if not phase.rand:
+            return g.runPhase(phase.blocks, phase.lamda)
 
-                for trial in range(num_trials):
-                    random.shuffle(phase.elems)
+        return g.runRandomPhase(phase.blocks, phase.lamda, args.num_trials, self.phase_seed(args.seed, phase_num), args.tolerance, Sampler.get(args.sampler))
 
-                    g.s = initial_strengths.copy()
-                    strength_hist = g.runPhase(phase.elems, phase.lamda)
-                    hist.append(strength_hist)
-                    final_strengths.append(g.s.copy())
+    # Seed of the permutations of a randomised phase, derived from the seed of the
+    # arguments, the name of this group, and the index of the phase. Without a seed,
+    # every run uses fresh entropy.
+    def phase_seed(self, seed: None | int, phase_num: int) -> np.random.SeedSequence:
+        return np.random.SeedSequence(seed, spawn_key = (int.from_bytes(self.name.encode(), 'little'), phase_num))
 
-                results.append([
-                    Environment.avg([h[x] for h in hist if x < len(h)])
-                    for x in range(max(len(h) for h in hist))
-                ])
+    # Like run_all_phases, but starts after the phases in `checkpoints`, which contain
+    # the results of the first len(checkpoints) phases. Returns the results along with
+    # the checkpoints of every phase.
+    def run_from_checkpoints(self, args: RWArgs, checkpoints: list[Checkpoint]) -> tuple[list[dict[str, StimulusHistory]], list[Checkpoint]]:
+        group = self.initial_group(args)
+        checkpoints = list(checkpoints)
+
+        if checkpoints:
+            # Only the CS seen in the checkpointed phases come from the checkpoint. The
+            # rest keep their initial values from `args`, since the key of a checkpoint
+            # doesn't include their parameters.
+            previous = checkpoints[-1][1]
+            seen = set.union(set(), *[phase.cs() for phase in self.phases[:len(checkpoints)]])
+            group.s = Environment(s = {cs: (previous.s[cs] if cs in seen else s).copy() for cs, s in group.s.s.items()})
+
+        for phase_num in range(len(checkpoints), len(self.phases)):
+            hist = dict(self.run_phase(group, phase_num, args))
+            checkpoints.append((hist, group.s.copy()))
+
+        strengths = self.group_results([hist for hist, _ in checkpoints], args)
+        return strengths, checkpoints
+
+    def group_results(self, results: list[dict[str, StimulusHistory]], args: RWArgs) -> list[dict[str, StimulusHistory]]:
+        group_strengths: list[dict[str, StimulusHistory]] = [{} for _ in results]
+        for phase_num, hist in enumerate(results):
+            # Only the requested compounds are summed, rather than every combination of the CS in the phase.
+            requested = self.phases[phase_num].compound_cs() if args.plot_stimuli is None else set(args.plot_stimuli)
+            for cs in sorted(requested, key = lambda x: (len(x), x)):
+                if cs and cs == ''.join(sorted(set(cs))) and all(k in hist for k in cs):
+                    group_strengths[phase_num][f'{self.name} - {cs}'] = StimulusHistory.sum([hist[k] for k in cs])
+                    group_strengths[phase_num][f'{self.name} - {cs}'].runs = hist[cs[0]].runs
+
+            # The variance of a compound depends on the covariance of its parts,
+            # so only simple CS keep the variance of randomised phases.
+            for cs, h in hist.items():
+                key = f'{self.name} - {cs}'
+                if key in group_strengths[phase_num]:
+                    group_strengths[phase_num][key].variance = h.variance
 
-                g.s = Environment.avg(final_strengths)
+        return group_strengths
 
-        return results
+# Run several experiments with the same arguments, returning their results in the
+# same order as `experiments`. When an executor is given every experiment runs as a
+# separate task, so both the arguments and the experiments must be picklable.
+def run_experiments(experiments: list[Experiment], args: RWArgs, executor: None | Executor = None) -> list[list[dict[str, StimulusHistory]]]:
+    return list(iter_experiments(experiments, args, executor))
 
-    def group_results(self, results: list[list[Environment]], args: RWArgs) -> list[dict[str, StimulusHistory]]:
-        group_strengths = [StimulusHistory.emptydict() for _ in results]
-        for phase_num, strength_hist in enumerate(results):
-            for strengths in strength_hist:
-                for cs in strengths.ordered_cs():
-                    current_phase = self.phases[phase_num]
-                    if args.plot_stimuli is None and cs in current_phase.compound_cs() or args.plot_stimuli is not None and cs in args.plot_stimuli:
-                        group_strengths[phase_num][f'{self.name} - {cs}'].add(strengths[cs])
+# Same as run_experiments, but the results are returned as each experiment finishes,
+# so that they don't all have to be kept in memory.
+def iter_experiments(experiments: list[Experiment], args: RWArgs, executor: None | Executor = None) -> Iterator[list[dict[str, StimulusHistory]]]:
+    if executor is None:
+        return (experiment.run_all_phases(args) for experiment in experiments)
 
-        return group_strengths
+    return executor.map(Experiment.run_all_phases, experiments, repeat(args))
+
+# Same as run_experiments, but every experiment starts from its own checkpoints.
+def run_from_checkpoints(experiments: list[Experiment], args: RWArgs, checkpoints: list[list[Checkpoint]], executor: None | Executor = None) -> list[tuple[list[dict[str, StimulusHistory]], list[Checkpoint]]]:
+    if executor is None:
+        return [experiment.run_from_checkpoints(args, c) for experiment, c in zip(experiments, checkpoints)]
+
+    return list(executor.map(Experiment.run_from_checkpoints, experiments, repeat(args), checkpoints))
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import csv
+import sys
+import zipfile
+
+import numpy as np
+
+from Environment import StimulusHistory
+
+# Exports write the histories of every group, phase, CS, and trial to a file, one
+# group at a time, so that the results of a group can be discarded once written.
+#
+# CSV files have one row per step, with the columns `group`, `phase`, `cs`, `step`
+# and one column per field, like the tables of `Simulator.py --sweep`. NPZ files
+# have one array per field of every history, named `group/phase/cs/field`, so that
+# `np.load(file)['Control/1/A/assoc']` is the associative strength of A in the
+# first phase of group Control.
+#
+# The histories of randomised phases are the average of their permutations, and
+# simple CS also have the variance of the permutations at every step. It's written
+# in the columns `{field}_var` of CSV files, which are empty for other histories,
+# and in the arrays `group/phase/cs/{field}_var` of NPZ files.
+
+export_fields = ('assoc', 'Ve', 'Vi', 'alpha', 'alpha_mack', 'alpha_hall')
+
+def group_histories(name: str, strengths: list[dict[str, StimulusHistory]]):
+    for phase_num, phase_strengths in enumerate(strengths, start = 1):
+        for key, hist in phase_strengths.items():
+            yield phase_num, key.removeprefix(f'{name} - '), hist
+
+class CSVExport:
+    def __init__(self, path: str):
+        self.file = sys.stdout if path == '-' else open(path, 'w', newline = '')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(['group', 'phase', 'cs', 'step', *export_fields, *(f'{field}_var' for field in export_fields)])
+
+    def write_group(self, name: str, strengths: list[dict[str, StimulusHistory]]):
+        rows = [StimulusHistory.index[field] for field in export_fields]
+        for phase_num, cs, hist in group_histories(name, strengths):
+            # Histories can have more capacity than steps, so only the first len(hist)
+            # columns are written.
+            if hist.variance is None:
+                variances = [[''] * len(rows)] * len(hist)
+            else:
+                variances = hist.variance.values[rows, :len(hist)].T.tolist()
+
+            for step, (values, variance) in enumerate(zip(hist.values[rows, :len(hist)].T.tolist(), variances)):
+                self.writer.writerow([name, phase_num, cs, step, *values, *variance])
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+class NPZExport:
+    def __init__(self, path: str):
+        self.zip = zipfile.ZipFile(path, 'w', compression = zipfile.ZIP_DEFLATED, allowZip64 = True)
+
+    # Arrays are written in the same format as np.savez_compressed, but one at a time.
+    def write_group(self, name: str, strengths: list[dict[str, StimulusHistory]]):
+        for phase_num, cs, hist in group_histories(name, strengths):
+            for field in export_fields:
+                with self.zip.open(f'{name}/{phase_num}/{cs}/{field}.npy', 'w', force_zip64 = True) as f:
+                    np.lib.format.write_array(f, np.ascontiguousarray(getattr(hist, field)))
+
+                if hist.variance is not None:
+                    with self.zip.open(f'{name}/{phase_num}/{cs}/{field}_var.npy', 'w', force_zip64 = True) as f:
+                        np.lib.format.write_array(f, np.ascontiguousarray(getattr(hist.variance, field)[:len(hist)]))
+
+    def close(self):
+        self.zip.close()
+
+# Open an export, choosing its format from the extension of the path. A path of
+# `-` writes a CSV table to standard output.
+def open_export(path: str) -> CSVExport | NPZExport:
+    if path == '-' or path.endswith('.csv'):
+        return CSVExport(path)
+    if path.endswith('.npz'):
+        return NPZExport(path)
+
+    raise ValueError(f'Output file "{path}" should end in .csv or .npz')
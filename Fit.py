@@ -0,0 +1,245 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import sys
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import replace
+from itertools import repeat
+
+from AdaptiveType import AdaptiveType
+from Experiment import Experiment, RWArgs, run_experiments
+
+# Fit the parameters of a model to observed associative strengths.
+#
+# The observed data is a CSV file with the columns `group`, `phase`, `cs`, `step`, and
+# `assoc`, where `phase` starts at 1 and `step` is the amount of times the CS was seen
+# in that phase, like in the output of `Simulator.py --sweep`. The fitted parameters
+# are the ones that minimise the mean squared error between the simulated and the
+# observed associative strengths.
+#
+# The optimiser is a compass search: on each iteration, every parameter is moved up
+# and down by the current step size, and all of these candidates are evaluated in
+# parallel. The search moves to the best candidate if it's better than the current
+# point, and otherwise halves the step size.
+
+# Fields of RWArgs of the parameters of AdaptiveType.parameters(), when they differ.
+arg_names = dict(
+    betan = 'beta_neg',
+)
+
+# Range of values of each parameter; parameters not here are in [0, 1].
+bounds = dict(
+    lamda = (0., 2.),
+    kay = (0., 10.),
+)
+
+Observations = dict[tuple[str, int, str, int], float]
+
+def read_observations(file) -> Observations:
+    observed = {}
+    for row in csv.DictReader(file):
+        key = (row['group'], int(row['phase']), row['cs'], int(row['step']))
+        observed[key] = float(row['assoc'])
+
+    return observed
+
+def initial_args(adaptive_type: str, num_trials: int) -> RWArgs:
+    defaults = AdaptiveType.initial_defaults() | AdaptiveType.types()[adaptive_type].defaults()
+    return RWArgs(
+        adaptive_type = adaptive_type,
+        alphas = {},
+        alpha_macks = {},
+        alpha_halls = {},
+        saliences = {},
+        habituations = {},
+        alpha = defaults['alpha'],
+        alpha_mack = defaults['alpha_mack'],
+        alpha_hall = defaults['alpha_hall'],
+        beta = defaults['beta'],
+        beta_neg = defaults['betan'],
+        lamda = defaults['lamda'],
+        gamma = defaults['gamma'],
+        thetaE = defaults['thetaE'],
+        thetaI = defaults['thetaI'],
+        salience = defaults['salience'],
+        habituation = defaults['habituation'],
+        rho = defaults['rho'],
+        nu = defaults['nu'],
+        kay = defaults['kay'],
+        window_size = 1,
+        xi_hall = 0.5,
+        num_trials = num_trials,
+    )
+
+# Parameters of a model that are fitted along with others they only appear multiplied
+# by, along with those others.
+def confounded_parameters(adaptive_type: str, parameters: list[str]) -> dict[str, list[str]]:
+    confounded = {}
+    for parameter, factors in AdaptiveType.types()[adaptive_type].product_parameters().items():
+        fitted = [f for f in factors if f in parameters]
+        if parameter in parameters and fitted:
+            confounded[parameter] = fitted
+
+    return confounded
+
+# Parameters fitted by default: every parameter of the model, except the ones that
+# can't be identified from the others.
+def default_parameters(adaptive_type: str) -> list[str]:
+    parameters = AdaptiveType.types()[adaptive_type].parameters()
+    confounded = confounded_parameters(adaptive_type, parameters)
+    return [p for p in parameters if p not in confounded]
+
+# Parameters that aren't fitted but multiply some fitted ones are held at 1, so that
+# the fitted ones stand for the whole product and can take any value within their
+# bounds, rather than being scaled down by the default of the held parameter.
+def hold_products(adaptive_type: str, parameters: list[str], args: RWArgs) -> tuple[RWArgs, dict[str, list[str]]]:
+    held = {}
+    for parameter, factors in AdaptiveType.types()[adaptive_type].product_parameters().items():
+        fitted = [f for f in factors if f in parameters]
+        if parameter not in parameters and fitted:
+            held[parameter] = fitted
+
+    return replace(args, **{arg_names.get(p, p): 1. for p in held}), held
+
+# Mean squared error of a set of parameters. Randomised phases are run with a
+# fixed seed, so the same parameters always have the same error.
+def evaluate(experiments: list[Experiment], args: RWArgs, observed: Observations, seed: int, values: dict[str, float]) -> float:
+    args = replace(args, seed = seed, **{arg_names.get(k, k): v for k, v in values.items()})
+
+    simulated = {}
+    for experiment, strengths in zip(experiments, run_experiments(experiments, args)):
+        for phase_num, phase_strengths in enumerate(strengths, start = 1):
+            for key, hist in phase_strengths.items():
+                cs = key.removeprefix(f'{experiment.name} - ')
+                simulated[experiment.name, phase_num, cs] = hist.assoc
+
+    error = 0.
+    for (group, phase, cs, step), value in observed.items():
+        assoc = simulated.get((group, phase, cs))
+        if assoc is None or step >= len(assoc):
+            return float('inf')
+
+        error += (assoc[step] - value) ** 2
+
+    return error / max(len(observed), 1)
+
+class Fitter:
+    experiments: list[Experiment]
+    args: RWArgs
+    observed: Observations
+    seed: int
+
+    parameters: list[str]
+    executor: None | Executor
+
+    # Error of every evaluated set of parameters, so that candidates that are seen
+    # again during the search don't have to be simulated again.
+    cache: dict[tuple[float, ...], float]
+
+    def __init__(self, experiments: list[Experiment], args: RWArgs, observed: Observations, parameters: list[str], seed: int = 0, executor: None | Executor = None):
+        self.experiments = experiments
+        self.args = args
+        self.observed = observed
+        self.seed = seed
+        self.parameters = parameters
+        self.executor = executor
+        self.cache = {}
+
+    # Evaluate several candidates, returning their errors in the same order.
+    def errors(self, candidates: list[tuple[float, ...]]) -> list[float]:
+        keys = [tuple(round(x, 12) for x in c) for c in candidates]
+        missing = list(dict.fromkeys(k for k in keys if k not in self.cache))
+
+        values = [dict(zip(self.parameters, k)) for k in missing]
+        if self.executor is None:
+            results = map(evaluate, repeat(self.experiments), repeat(self.args), repeat(self.observed), repeat(self.seed), values)
+        else:
+            results = self.executor.map(evaluate, repeat(self.experiments), repeat(self.args), repeat(self.observed), repeat(self.seed), values)
+
+        self.cache.update(zip(missing, results))
+        return [self.cache[k] for k in keys]
+
+    def clip(self, parameter: str, value: float) -> float:
+        low, high = bounds.get(parameter, (0., 1.))
+        return min(max(value, low), high)
+
+    # Run a compass search from `start`, returning the best parameters and their error.
+    def fit(self, start: tuple[float, ...], step: float = .1, tolerance: float = 1e-4, max_iterations: int = 200, log = None) -> tuple[tuple[float, ...], float]:
+        best = tuple(self.clip(p, x) for p, x in zip(self.parameters, start))
+        [best_error] = self.errors([best])
+
+        for iteration in range(max_iterations):
+            if step < tolerance:
+                break
+
+            candidates = []
+            for e, parameter in enumerate(self.parameters):
+                for direction in (1, -1):
+                    candidate = list(best)
+                    candidate[e] = self.clip(parameter, best[e] + direction * step)
+                    candidates.append(tuple(candidate))
+
+            errors = self.errors(candidates)
+            error, candidate = min(zip(errors, candidates))
+            if error < best_error:
+                best, best_error = candidate, error
+            else:
+                step /= 2
+
+            if log is not None:
+                print(f'Iteration {iteration + 1}: error {best_error:.6g}, step {step:.3g}, {len(self.cache)} evaluations', file = log)
+
+        return best, best_error
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description = 'Fit the parameters of a model to observed associative strengths.')
+    parser.add_argument('experiment_file', type = argparse.FileType('r'), help = 'Path to the experiment file.')
+    parser.add_argument('observed_file', type = argparse.FileType('r'), help = 'CSV file with the columns group, phase, cs, step, and assoc.')
+    parser.add_argument('--adaptive-type', choices = AdaptiveType.types().keys(), default = 'Rescorla Wagner', help = 'Model to fit.')
+    parser.add_argument('--parameters', type = lambda x: x.split(','), help = 'Comma-separated list of parameters to fit. By default, all the parameters of the model, except the ones that only appear multiplied by others (such as alpha in Rescorla Wagner), which are held at 1.')
+    parser.add_argument('--num-trials', type = int, default = 100, help = 'Amount of trials done in randomised phases.')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Seed used for randomised phases on every evaluation.')
+    parser.add_argument('--step', type = float, default = .1, help = 'Initial step size of the search.')
+    parser.add_argument('--tolerance', type = float, default = 1e-4, help = 'Stop when the step size is smaller than this.')
+    parser.add_argument('--max-iterations', type = int, default = 200, help = 'Maximum amount of iterations of the search.')
+    parser.add_argument('--jobs', type = int, help = 'Amount of processes used to evaluate candidates. By default, every core.')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    experiments = []
+    for line in args.experiment_file.readlines():
+        if not line.strip():
+            continue
+
+        name, *phase_strs = line.strip().split('|')
+        experiments.append(Experiment(name.strip(), phase_strs))
+
+    observed = read_observations(args.observed_file)
+    run_args = initial_args(args.adaptive_type, args.num_trials)
+
+    parameters = args.parameters or default_parameters(args.adaptive_type)
+    unknown = [p for p in parameters if not hasattr(run_args, arg_names.get(p, p))]
+    if unknown:
+        raise KeyError(f"Parameters not recognised: {' '.join(unknown)}.")
+
+    for parameter, factors in confounded_parameters(args.adaptive_type, parameters).items():
+        print(f'Warning: {parameter} only appears multiplied by {" and ".join(factors)} in {args.adaptive_type}, so only their product can be fitted; keep {parameter} fixed.', file = sys.stderr)
+
+    run_args, held = hold_products(args.adaptive_type, parameters, run_args)
+    for parameter, factors in held.items():
+        print(f'{parameter} is held at 1, so {" and ".join(factors)} are fitted as their products with {parameter}.', file = sys.stderr)
+
+    start = tuple(getattr(run_args, arg_names.get(p, p)) for p in parameters)
+    with ProcessPoolExecutor(max_workers = args.jobs) as executor:
+        fitter = Fitter(experiments, run_args, observed, parameters, seed = args.seed, executor = executor)
+        best, error = fitter.fit(start, step = args.step, tolerance = args.tolerance, max_iterations = args.max_iterations, log = sys.stderr)
+
+    print(f'Mean squared error: {error:.6g}')
+    for parameter, value in zip(parameters, best):
+        print(f'{parameter}: {value:.6g}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import inspect
+import json
+import re
+import sys
+from concurrent.futures import as_completed
+from dataclasses import asdict, dataclass, replace
+from pathlib import Path
+
+import matplotlib
+
+import AdaptiveType as adaptive_type_module
+from AdaptiveType import AdaptiveType
+from Environment import StimulusHistory
+from Experiment import Experiment, RWArgs, run_experiments
+from Fit import initial_args
+
+# The gallery has the figures of every model on every experiment file, saved as
+# "{model}-{experiment}_{phase}.png".
+#
+# Every figure of a model and an experiment is built by a single job. The inputs of
+# a job (the experiment file, the arguments, and the source of the model) are hashed,
+# and the hash is kept in a manifest in the gallery directory along with the files
+# it produced. When the gallery is built again, only jobs whose hash changed or
+# whose files are missing are run. Changes to the simulator or the plots themselves
+# aren't part of the hash, so use --force to rebuild everything after them.
+
+manifest_name = 'manifest.json'
+
+# Bump this when the way the gallery is built changes, to rebuild every job.
+gallery_version = 1
+
+def model_slug(adaptive_type: str) -> str:
+    return adaptive_type.lower().replace(' ', '_')
+
+# Source of a model: its class and the classes it inherits from, and the functions
+# of AdaptiveType.py they call.
+def model_source(adaptive_type: str) -> str:
+    classes = [c for c in AdaptiveType.types()[adaptive_type].__mro__ if issubclass(c, AdaptiveType)]
+    source = ''.join(inspect.getsource(c) for c in classes)
+
+    for name, function in inspect.getmembers(adaptive_type_module, inspect.isfunction):
+        if function.__module__ == adaptive_type_module.__name__ and re.search(rf'\b{name}\(', source):
+            source += inspect.getsource(function)
+
+    return source
+
+@dataclass
+class GalleryJob:
+    adaptive_type: str
+    experiment_file: Path
+    args: RWArgs
+    dpi: None | int
+
+    @property
+    def name(self) -> str:
+        return f'{model_slug(self.adaptive_type)}-{self.experiment_file.stem}'
+
+    def key(self) -> str:
+        inputs = dict(
+            version = gallery_version,
+            experiment = self.experiment_file.read_text(),
+            args = asdict(self.args),
+            model = model_source(self.adaptive_type),
+            dpi = self.dpi,
+        )
+        return hashlib.sha256(json.dumps(inputs, sort_keys = True).encode()).hexdigest()
+
+def gallery_jobs(experiments_dir: Path, models: list[str], num_trials: int, dpi: None | int) -> list[GalleryJob]:
+    jobs = []
+    for adaptive_type in models:
+        macknhall = AdaptiveType.types()[adaptive_type].should_plot_macknhall()
+        # Randomised phases always use the same seed, so that a job with the same hash
+        # always produces the same figures.
+        args = replace(initial_args(adaptive_type, num_trials), plot_alpha = not macknhall, plot_macknhall = macknhall, seed = 0)
+
+        for experiment_file in sorted(experiments_dir.glob('*.rw')):
+            jobs.append(GalleryJob(adaptive_type, experiment_file, args, dpi))
+
+    return jobs
+
+# Run a job and save its figures to `output`, returning the names of the files.
+def build_job(job: GalleryJob, output: Path) -> list[str]:
+    from Plots import figure_tasks, save_figures
+
+    experiments = []
+    for line in job.experiment_file.read_text().splitlines():
+        if not line.strip():
+            continue
+
+        name, *phase_strs = line.strip().split('|')
+        experiments.append(Experiment(name.strip(), phase_strs))
+
+    results = run_experiments(experiments, job.args)
+
+    strengths = [StimulusHistory.emptydict() for _ in results[0]]
+    for local_strengths in results:
+        strengths = [a | b for a, b in zip(strengths, local_strengths)]
+
+    tasks = figure_tasks(
+        strengths,
+        phases = {experiment.name: experiment.phases for experiment in experiments},
+        filename = str(output / job.name),
+        plot_alpha = job.args.plot_alpha,
+        plot_macknhall = job.args.plot_macknhall,
+        title_suffix = job.adaptive_type,
+        dpi = job.dpi,
+    )
+    save_figures(tasks)
+
+    return [Path(path).name for path, _ in tasks]
+
+def read_manifest(output: Path) -> dict[str, dict]:
+    path = output / manifest_name
+    if not path.exists():
+        return {}
+
+    return json.loads(path.read_text())
+
+def write_manifest(output: Path, manifest: dict[str, dict]):
+    path = output / manifest_name
+    temp = path.with_suffix('.tmp')
+    temp.write_text(json.dumps(manifest, indent = 2, sort_keys = True))
+    temp.replace(path)
+
+# Build every job that isn't up to date, returning the names of the jobs that were built.
+def build_gallery(jobs: list[GalleryJob], output: Path, workers: None | int = None, force: bool = False, log = None) -> list[str]:
+    output.mkdir(parents = True, exist_ok = True)
+    manifest = read_manifest(output)
+
+    pending = []
+    for job in jobs:
+        key = job.key()
+        entry = manifest.get(job.name)
+        up_to_date = (
+            entry is not None and
+            entry['key'] == key and
+            all((output / f).exists() for f in entry['files'])
+        )
+        if force or not up_to_date:
+            pending.append((job, key))
+
+    if log is not None:
+        print(f'{len(jobs) - len(pending)} jobs up to date, {len(pending)} to build.', file = log)
+
+    def finish(job: GalleryJob, key: str, files: list[str]):
+        # Remove the files of the previous build that weren't produced again, for
+        # example when the experiment has fewer phases now.
+        old = manifest.get(job.name, {}).get('files', [])
+        for f in set(old) - set(files):
+            (output / f).unlink(missing_ok = True)
+
+        manifest[job.name] = dict(key = key, files = files)
+        write_manifest(output, manifest)
+
+        if log is not None:
+            print(f'Built {job.name} ({len(files)} figures)', file = log)
+
+    if workers == 1 or len(pending) <= 1:
+        for job, key in pending:
+            finish(job, key, build_job(job, output))
+    else:
+        from Plots import plot_executor
+
+        with plot_executor(workers or None) as executor:
+            futures = {executor.submit(build_job, job, output): (job, key) for job, key in pending}
+            for future in as_completed(futures):
+                finish(*futures[future], future.result())
+
+    return [job.name for job, _ in pending]
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description = 'Build the figures of every model on every experiment file, skipping the ones that are up to date.')
+    parser.add_argument('--output', type = Path, default = Path('Plots'), help = 'Directory where the figures and the manifest are saved.')
+    parser.add_argument('--experiments', type = Path, default = Path('Experiments'), help = 'Directory with the experiment files.')
+    parser.add_argument('--models', nargs = '*', choices = AdaptiveType.types().keys(), default = list(AdaptiveType.types().keys()), help = 'Models to plot.')
+    parser.add_argument('--num-trials', type = int, default = 100, help = 'Amount of trials done in randomised phases.')
+    parser.add_argument('--dpi', type = int, help = 'DPI of the saved figures.')
+    parser.add_argument('--jobs', type = int, help = 'Amount of processes used to build the figures. By default, every core.')
+    parser.add_argument('--force', action = 'store_true', help = 'Rebuild every figure, even if it is up to date.')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    matplotlib.use('Agg')
+
+    jobs = gallery_jobs(args.experiments, args.models, args.num_trials, args.dpi)
+    build_gallery(jobs, args.output, workers = args.jobs, force = args.force, log = sys.stderr)
+
+if __name__ == '__main__':
+    main()
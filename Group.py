@@ -1,7 +1,33 @@
 from __future__ import annotations
 
-from Environment import Environment, StimulusHistory, Stimulus
+import math
+from collections.abc import Iterable, Iterator
+from itertools import groupby
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from Environment import Environment, StimulusHistory, Stimulus, StimulusAccumulator, Window
 from AdaptiveType import AdaptiveType, RunParameters
+from Kernel import Kernel
+from Sampler import Sampler
+
+# A block is a (CS, US, count) tuple representing `count` identical consecutive trials.
+Block = tuple[str, str, int]
+
+# Returns the distinct (CS, US) parts of some blocks, in order of appearance, along
+# with the total amount of trials of each one.
+def distinct_parts(blocks: Iterable[Block]) -> tuple[list[tuple[str, str]], list[int]]:
+    counts: dict[tuple[str, str], int] = {}
+    for part, plus, count in blocks:
+        counts[part, plus] = counts.get((part, plus), 0) + count
+
+    return list(counts.keys()), list(counts.values())
+
+# Groups consecutive identical trials into blocks.
+def trial_blocks(trials: Iterable[tuple[str, str]]) -> Iterator[Block]:
+    for (part, plus), run in groupby(trials):
+        yield part, plus, sum(1 for _ in run)
 
 class Group:
     name: str
@@ -12,6 +38,25 @@ class Group:
     adaptive_type: AdaptiveType
     window_size: None | int
 
+    # Either 'object', which runs each Stimulus separately, or 'array', which
+    # uses Kernel when the adaptive type supports it.
+    engine: str
+
+    # Least amount of CS for which a phase that isn't randomised runs through Kernel.
+    # A single row only runs faster as arrays when there are many CS.
+    kernel_min_cs: int = 8
+
+    # Amount of permutations of a randomised phase that Kernel runs at the same time.
+    batch_size: int = 250
+
+    # Approximate amount of memory the histories of a batch can use. Batches of long
+    # phases have fewer permutations, so that they stay within it.
+    batch_bytes: int = 64 * 2**20
+
+    # Least amount of permutations run between checks of the standard error, when
+    # randomised phases stop on a tolerance.
+    tolerance_batch_size: int = 50
+
     def __init__(
         self,
         name: str,
@@ -40,6 +85,7 @@ class Group:
         adaptive_type: None | str = None,
         window_size: None | int = None,
         xi_hall: None | float = None,
+        engine: str = 'array',
     ):
         cs = (cs or set()) | alphas.keys() | saliences.keys() | habituations.keys() | alpha_macks.keys() | alpha_halls.keys()
         if cs is not None:
@@ -62,6 +108,7 @@ class Group:
                     alpha_hall = alpha_halls[k],
                     rho = rho,
                     nu = nu,
+                    window = Window(window_size or 0),
                 )
                 for k in cs
             }
@@ -69,60 +116,204 @@ class Group:
 
         self.adaptive_type = AdaptiveType.get(adaptive_type, betan = betan, betap = betap, lamda = lamda, xi_hall = xi_hall, gamma = gamma, thetaE = thetaE, thetaI = thetaI, kay = kay)
         self.window_size = window_size
+        self.engine = engine
 
         # (∃ x) len(x) > 1 if `use_configurals`.
         # `use_configurals` was removed from the current version of the program,
         # but we keep this line as we might re-add it later.
         self.cs = [x for x in alphas.keys() if len(x) == 1]
 
-    # runPhase runs a single trial of a phase, in order, and returns a list of the Strength values
-    # of its CS at every step.
+    # Whether this group runs its phases through Kernel.
+    def useArrays(self) -> bool:
+        return self.engine == 'array' and self.adaptive_type.supports_arrays()
+
+    # runPhase runs a single trial of a phase, in order, and returns the history of the
+    # Strength values of each CS at every step where it's present.
     # It also modifies `self.s` to account for all the strengths modified in this phase.
-    def runPhase(self, parts: list[tuple[str, str]], phase_lamda: None | float) -> list[Environment]:
+    # The phase is given as a list of blocks of identical trials.
+    def runPhase(self, blocks: Iterable[Block], phase_lamda: None | float) -> dict[str, StimulusHistory]:
+        if self.adaptive_type.supports_fast_forward():
+            return self.runPhaseFastForward(blocks, phase_lamda)
+
+        if self.useArrays() and len(self.s.s) >= self.kernel_min_cs:
+            return self.runPhaseArrays(list(blocks), phase_lamda)
+
         hist = StimulusHistory.emptydict()
+        for part, plus, count in blocks:
+            for _ in range(count):
+                self.runTrial(part, plus, phase_lamda, hist)
 
-        for part, plus in parts:
-            if plus == '+':
-                beta, lamda, sign = self.adaptive_type.betap, phase_lamda or self.adaptive_type.lamda, 1
-            else:
-                beta, lamda, sign = self.adaptive_type.betan, 0., -1
+        return hist
+
+    def runParameters(self, part: str, plus: str, phase_lamda: None | float) -> RunParameters:
+        if plus == '+':
+            beta, lamda, sign = self.adaptive_type.betap, phase_lamda or self.adaptive_type.lamda, 1
+        else:
+            beta, lamda, sign = self.adaptive_type.betan, 0., -1
 
-            compounds = set(part)
+        compounds = set(part)
+        return RunParameters(
+            beta = beta,
+            lamda = lamda,
+            sign = sign,
+            sigma = sum(self.s[x].assoc for x in compounds),
+            sigmaE = sum(self.s[x].Ve for x in compounds),
+            sigmaI = sum(self.s[x].Vi for x in compounds),
+            count = len(compounds),
+            maxAssocRest = -1,
+        )
 
-            rp = RunParameters(
-                beta = beta,
-                lamda = lamda,
-                sign = sign,
-                sigma = sum(self.s[x].assoc for x in compounds),
-                sigmaE = sum(self.s[x].Ve for x in compounds),
-                sigmaI = sum(self.s[x].Vi for x in compounds),
-                count = len(compounds),
-                maxAssocRest = -1,
-            )
+    # runTrial runs a single trial, adding the new strengths of its CS to `hist`.
+    def runTrial(self, part: str, plus: str, phase_lamda: None | float, hist: dict[str, StimulusHistory]):
+        compounds = set(part)
+        rp = self.runParameters(part, plus, phase_lamda)
 
-            argmaxAssoc = max(compounds, key = lambda x: self.s[x].assoc)
-            maxAssoc = max(self.s[x].assoc for x in compounds)
-            secondMaxAssoc = max([self.s[x].assoc for x in compounds - {argmaxAssoc}], default = 0)
+        argmaxAssoc = max(compounds, key = lambda x: self.s[x].assoc)
+        maxAssoc = max(self.s[x].assoc for x in compounds)
+        secondMaxAssoc = max([self.s[x].assoc for x in compounds - {argmaxAssoc}], default = 0)
 
-            for cs in compounds:
-                if cs not in hist:
-                    hist[cs].add(self.s[cs])
+        for cs in compounds:
+            if cs not in hist:
+                hist[cs].add(self.s[cs])
 
-                # We need to calculate max_{i != cs} V_i.
-                # This is always either the maximum V_i, or the second maximum when i = cs.
-                rp.maxAssocRest = maxAssoc if cs != argmaxAssoc else secondMaxAssoc
-                self.adaptive_type.run_step(self.s[cs], rp)
+            # We need to calculate max_{i != cs} V_i.
+            # This is always either the maximum V_i, or the second maximum when i = cs.
+            rp.maxAssocRest = maxAssoc if cs != argmaxAssoc else secondMaxAssoc
+            self.adaptive_type.run_step(self.s[cs], rp)
 
-                if self.window_size is not None:
-                    if len(self.s[cs].window) >= self.window_size:
-                        self.s[cs].window.popleft()
+            if self.window_size is not None:
+                # The window has a capacity of window_size, so it drops the oldest value by itself.
+                self.s[cs].window.append(self.s[cs].assoc)
+                window_avg = self.s[cs].window.sum() / len(self.s[cs].window)
 
-                    self.s[cs].window.append(self.s[cs].assoc)
-                    window_avg = sum(self.s[cs].window) / len(self.s[cs].window)
+                # delta_ma_hall is modified using the previous associated value.
+                self.s[cs].delta_ma_hall = window_avg - hist[cs].assoc[-1]
 
-                    # delta_ma_hall is modified using the previous associated value.
-                    self.s[cs].delta_ma_hall = window_avg - hist[cs].assoc[-1]
+            hist[cs].add(self.s[cs])
 
-                hist[cs].add(self.s[cs])
+    # runPhaseFastForward is equivalent to runPhase for models that support
+    # AdaptiveType.fast_forward. Blocks of identical consecutive trials are computed in
+    # closed form and added to the history at once; the rest are run one at a time.
+    def runPhaseFastForward(self, blocks: Iterable[Block], phase_lamda: None | float) -> dict[str, StimulusHistory]:
+        hist = StimulusHistory.emptydict()
+
+        for part, plus, remaining in blocks:
+            while remaining > 0:
+                if remaining > 1:
+                    compounds = list(set(part))
+                    stimuli = [self.s[cs] for cs in compounds]
+                    assocs = self.adaptive_type.fast_forward(stimuli, self.runParameters(part, plus, phase_lamda), remaining)
+                    if assocs is not None:
+                        for cs, assoc in zip(compounds, assocs.T):
+                            self.fastForwardStimulus(cs, assoc, hist)
+                        break
+
+                self.runTrial(part, plus, phase_lamda, hist)
+                remaining -= 1
+
+        return hist
+
+    # Add the steps of a CS whose associative strength after each trial is `assoc`,
+    # updating its sliding window and delta_ma_hall as runTrial would.
+    def fastForwardStimulus(self, cs: str, assoc: np.ndarray, hist: dict[str, StimulusHistory]):
+        s = self.s[cs]
+        if cs not in hist:
+            hist[cs].add(s)
+
+        columns = dict(assoc = assoc)
+        windows = np.zeros((len(assoc), 0))
+        window_lens = np.zeros(len(assoc), dtype = int)
+
+        if self.window_size is not None:
+            # The window after trial k contains the last values of the previous window
+            # followed by assoc[:k], so it's a sliding window over their concatenation.
+            previous = list(s.window)
+            values = np.concatenate([np.zeros(self.window_size), previous, assoc])
+            windows = sliding_window_view(values, self.window_size)[len(previous) + 1:]
+            window_lens = np.minimum(len(previous) + np.arange(1, len(assoc) + 1), self.window_size)
+
+            # delta_ma_hall is modified using the previous associated value.
+            previous_assoc = np.concatenate([[s.assoc], assoc[:-1]])
+            columns['delta_ma_hall'] = windows.sum(axis = 1) / window_lens - previous_assoc
+
+            s.window = Window(self.window_size, windows[-1, self.window_size - window_lens[-1]:].tolist())
+            s.delta_ma_hall = float(columns['delta_ma_hall'][-1])
+
+        hist[cs].extend(s, columns, windows, window_lens)
+        s.assoc = float(assoc[-1])
+
+    # runPhaseArrays is equivalent to runPhase, but runs every trial through Kernel.
+    def runPhaseArrays(self, blocks: list[Block], phase_lamda: None | float) -> dict[str, StimulusHistory]:
+        distinct, _ = distinct_parts(blocks)
+        index = {part: e for e, part in enumerate(distinct)}
+        orders = np.repeat(
+            np.array([index[part, plus] for part, plus, _ in blocks], dtype = int),
+            [count for _, _, count in blocks],
+        ).reshape(1, -1)
+
+        kernel = Kernel(self.s, self.adaptive_type, self.window_size)
+        kernel.runPhase(distinct, orders, phase_lamda)
+        self.s = kernel.environment()
+
+        return kernel.histories()
+
+    # runRandomPhase runs `num_trials` random permutations of a phase, chosen by
+    # `sampler`, and returns the average of their histories, where the variance of
+    # each history contains the variance of the permutations at each step.
+    # It also sets `self.s` to the average of their final strengths.
+    #
+    # If `tolerance` is set, the permutations are run in batches of at least
+    # `tolerance_batch_size`, and they stop as soon as the standard error of the
+    # average associative strength is below `tolerance` at every step, so `num_trials`
+    # is only the maximum amount of permutations. Batches are made of whole groups of
+    # the sampler, so that the standard error is computed from independent groups.
+    # Since every group has its own stream, the result is the same as running that
+    # many permutations without a tolerance.
+    #
+    # The permutations are averaged as they finish, so the memory used does not
+    # depend on `num_trials`. When using Kernel, the permutations are run in batches
+    # of up to `batch_size` rows at the same time, as long as their histories fit in
+    # `batch_bytes`.
+    def runRandomPhase(self, blocks: list[Block], phase_lamda: None | float, num_trials: int, seed: np.random.SeedSequence, tolerance: None | float = None, sampler: None | Sampler = None) -> dict[str, StimulusHistory]:
+        sampler = sampler or Sampler()
+        initial_strengths = self.s.copy()
+        accumulator = StimulusAccumulator(group_size = sampler.group_size)
+
+        distinct, counts = distinct_parts(blocks)
+
+        batch_size = self.batch_size
+        if self.useArrays():
+            batch_size = min(batch_size, max(self.batch_bytes // Kernel.rowBytes(sum(counts), len(initial_strengths.s)), 1))
+
+        def whole_groups(rows: int) -> int:
+            return math.ceil(rows / sampler.group_size) * sampler.group_size
+
+        start = 0
+        rows = batch_size if tolerance is None else whole_groups(min(batch_size, self.tolerance_batch_size))
+        while start < num_trials:
+            rows = min(rows, num_trials - start)
+            orders = sampler.orders(counts, seed, start, rows)
+
+            if self.useArrays():
+                kernel = Kernel(initial_strengths, self.adaptive_type, self.window_size, rows = rows)
+                kernel.runPhase(distinct, orders, phase_lamda)
+                kernel.accumulate(accumulator)
+            else:
+                for order in orders:
+                    self.s = initial_strengths.copy()
+                    hist = self.runPhase(trial_blocks(distinct[index] for index in order), phase_lamda)
+                    accumulator.add(hist, self.s)
+
+            start += rows
+            if tolerance is not None:
+                error = accumulator.standard_error()
+                if error < tolerance:
+                    break
+
+                # The standard error falls with the square root of the amount of
+                # permutations, so the next batch has about as many as still needed.
+                needed = math.ceil(start * (error / tolerance) ** 2)
+                rows = whole_groups(min(max(needed - start, self.tolerance_batch_size), batch_size))
 
-        return Environment.fromHistories(hist)
+        self.s = accumulator.environment()
+        return accumulator.histories()
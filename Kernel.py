@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+import numpy as np
+
+from Environment import Environment, Stimulus, Window, StimulusHistory, StimulusAccumulator
+from AdaptiveType import AdaptiveType, RunParameters
+
+# Values routinely underflow to 0, but an overflow or an invalid value means that the
+# parameters diverge, which Group.runPhase reports as an OverflowError.
+def diverged(kind: str, flag: int):
+    raise OverflowError(f'{kind} encountered while running the phase')
+
+# Kernel is a struct-of-arrays version of Group.runPhase.
+#
+# Rather than keeping a Stimulus object per CS, it keeps every per-CS value in a
+# single float array of shape (fields, rows, cs), where each row is an independent
+# copy of the whole environment. A normal phase uses a single row; randomised
+# phases can use one row per permutation and advance all of them at the same time.
+#
+# Every trial is then a handful of masked reductions (sigma, sigmaE, sigmaI, and
+# the maximum associative strength of the rest of the compound) followed by a call
+# to AdaptiveType.step_arrays, which updates the CS present in the trial.
+class Kernel:
+    fields = Stimulus.fields
+
+    cs: list[str]
+    rows: int
+
+    adaptive_type: AdaptiveType
+    window_size: None | int
+
+    # values[f, r, c] is the value of field `fields[f]` of CS `cs[c]` in row `r`.
+    values: np.ndarray
+
+    # The sliding windows are right-aligned: window[r, c, -window_len[r, c]:] are the
+    # values in the window, and the rest of them are zero.
+    window: None | np.ndarray
+    window_len: None | np.ndarray
+
+    # records[f, r, n, c] is the value of field `fields[f]` of CS `cs[c]` in row `r`
+    # after it was seen `n` times in the last phase; counts[c] is the amount of
+    # times each CS was seen, which is the same for every row.
+    records: np.ndarray
+    counts: np.ndarray
+
+    def __init__(self, env: Environment, adaptive_type: AdaptiveType, window_size: None | int, rows: int = 1):
+        self.cs = sorted(env.s.keys())
+        self.rows = rows
+        self.adaptive_type = adaptive_type
+        self.window_size = window_size
+
+        self.values = np.empty((len(self.fields), rows, len(self.cs)))
+        for c, cs in enumerate(self.cs):
+            stimulus = env.s[cs]
+            for f, field in enumerate(self.fields):
+                self.values[f, :, c] = getattr(stimulus, field)
+
+        self.window = None
+        self.window_len = None
+        if window_size is not None:
+            self.window = np.zeros((rows, len(self.cs), window_size))
+            self.window_len = np.zeros((rows, len(self.cs)), dtype = int)
+            for c, cs in enumerate(self.cs):
+                window = list(env.s[cs].window)[-window_size:]
+                if window:
+                    self.window[:, c, -len(window):] = window
+                self.window_len[:, c] = len(window)
+
+        self.records = np.empty((len(self.fields), rows, 1, len(self.cs)))
+        self.counts = np.zeros(len(self.cs), dtype = int)
+
+    # Run a phase, where `parts` is the list of distinct (CS, US) parts of the phase
+    # and orders[r, t] is the index of the part used in trial `t` of row `r`.
+    def runPhase(self, parts: list[tuple[str, str]], orders: np.ndarray, phase_lamda: None | float):
+        rows, trials = orders.shape
+        assert rows == self.rows
+
+        index = {cs: c for c, cs in enumerate(self.cs)}
+        masks = np.zeros((len(parts), len(self.cs)), dtype = bool)
+        betas = np.empty((len(parts), 1))
+        lamdas = np.empty((len(parts), 1))
+        signs = np.empty((len(parts), 1))
+        sizes = np.empty((len(parts), 1))
+        for p, (part, plus) in enumerate(parts):
+            masks[p, [index[x] for x in set(part)]] = True
+            sizes[p] = len(set(part))
+            if plus == '+':
+                betas[p], lamdas[p], signs[p] = self.adaptive_type.betap, phase_lamda or self.adaptive_type.lamda, 1
+            else:
+                betas[p], lamdas[p], signs[p] = self.adaptive_type.betan, 0., -1
+
+        # Every row sees every part the same amount of times, so the CS counts
+        # (and so the length of every history) are the same for all of them.
+        self.counts = (np.bincount(orders[0], minlength = len(parts))[:, None] * masks).sum(axis = 0)
+
+        # The values of the CS present in each trial are written to their history as
+        # they change, rather than keeping the values of every CS after every trial.
+        # seen[r, c] is the amount of times CS `c` was seen so far in row `r`.
+        self.records = np.empty((len(self.fields), rows, self.counts.max(initial = 0) + 1, len(self.cs)))
+        self.records[:, :, 0, :] = self.values
+        seen = np.zeros((rows, len(self.cs)), dtype = int)
+
+        views = dict(zip(self.fields, self.values))
+        assoc = views['assoc']
+        delta_ma_hall = views['delta_ma_hall']
+        row_index = np.arange(rows)
+        cs_index = np.arange(len(self.cs))
+
+        s = SimpleNamespace()
+        with np.errstate(all = 'call', under = 'ignore', call = diverged):
+            for t in range(trials):
+                order = orders[:, t]
+                mask = masks[order]
+
+                # We need to calculate max_{i != cs} V_i for every CS in the compound.
+                # This is always either the maximum V_i, or the second maximum when i = cs.
+                masked_assoc = np.where(mask, assoc, -np.inf)
+                argmaxAssoc = masked_assoc.argmax(axis = 1)
+                maxAssoc = masked_assoc[row_index, argmaxAssoc]
+                masked_assoc[row_index, argmaxAssoc] = -np.inf
+                secondMaxAssoc = np.maximum.reduce(masked_assoc, axis = 1)
+                secondMaxAssoc[secondMaxAssoc == -np.inf] = 0
+
+                # Sum of assoc, Ve, and Vi of the CS in the compound.
+                sigmas = np.add.reduce(self.values[:3] * mask, axis = 2)[:, :, None]
+
+                rp = RunParameters(
+                    beta = betas[order],
+                    lamda = lamdas[order],
+                    sign = signs[order],
+                    sigma = sigmas[0],
+                    sigmaE = sigmas[1],
+                    sigmaI = sigmas[2],
+                    count = sizes[order],
+                    maxAssocRest = np.where(
+                        cs_index == argmaxAssoc[:, None],
+                        secondMaxAssoc[:, None],
+                        maxAssoc[:, None],
+                    ),
+                )
+
+                old_assoc = assoc.copy()
+                s.__dict__.update(views)
+                self.adaptive_type.run_step_arrays(s, rp)
+
+                # Only commit the values of the CS that are present in this trial.
+                for field, view in views.items():
+                    new = getattr(s, field)
+                    if new is not view:
+                        np.copyto(view, new, where = mask)
+
+                if self.window is not None:
+                    assert self.window_len is not None
+
+                    window = np.concatenate([self.window[:, :, 1:], assoc[:, :, None]], axis = 2)
+                    window_len = np.minimum(self.window_len + 1, self.window_size)
+                    window_avg = np.add.reduce(window, axis = 2) / window_len
+
+                    np.copyto(self.window, window, where = mask[:, :, None])
+                    np.copyto(self.window_len, window_len, where = mask)
+
+                    # delta_ma_hall is modified using the previous associated value.
+                    np.copyto(delta_ma_hall, window_avg - old_assoc, where = mask)
+
+                # The n-th value of a CS in its history is its value after the n-th
+                # trial where it was present.
+                row, c = np.nonzero(mask)
+                seen[row, c] += 1
+                self.records[:, row, seen[row, c], c] = self.values[:, row, c]
+
+    # Approximate amount of memory used by the histories of a single row of a phase
+    # with `trials` trials, for an environment with `cs` CS.
+    @classmethod
+    def rowBytes(cls, trials: int, cs: int) -> int:
+        return len(cls.fields) * (trials + 1) * cs * np.dtype(float).itemsize
+
+    # Returns the history of every CS seen in the last phase in a particular row,
+    # in the same format that runPhase uses.
+    def histories(self, row: int = 0) -> dict[str, StimulusHistory]:
+        hist = StimulusHistory.emptydict()
+        for c, cs in enumerate(self.cs):
+            if self.counts[c] == 0:
+                continue
+
+            hist[cs] = StimulusHistory.fromArrays(self.records[:, row, :self.counts[c] + 1, c])
+
+        return hist
+
+    # Adds every row, in order, to an accumulator.
+    def accumulate(self, accumulator: StimulusAccumulator):
+        present = [(c, cs) for c, cs in enumerate(self.cs) if self.counts[c] > 0]
+        for row in range(self.rows):
+            accumulator.addArrays(
+                {cs: self.records[:, row, :self.counts[c] + 1, c] for c, cs in present},
+                {cs: self.values[:, row, c] for c, cs in enumerate(self.cs)},
+                {cs: self.windowValues(row, c) for c, cs in enumerate(self.cs)},
+            )
+
+    # Returns the current state of a particular row.
+    def environment(self, row: int = 0) -> Environment:
+        s = {}
+        for c, cs in enumerate(self.cs):
+            # Set the values directly, since the constructor replaces falsy alphas.
+            window = Window(self.window_size or 0, self.windowValues(row, c).tolist())
+            s[cs] = Stimulus.fromValues(*self.values[:, row, c].tolist(), window = window)
+
+        return Environment(s = s)
+
+    # Values in the sliding window of a CS.
+    def windowValues(self, row: int, c: int) -> np.ndarray:
+        if self.window is None or self.window_len is None:
+            return np.empty(0)
+
+        return self.window[row, c, self.window.shape[2] - self.window_len[row, c]:]
@@ -5,29 +5,50 @@ if 'DISPLAY' in os.environ:
     os.environ["QT_QPA_PLATFORM"] = "xcb"
 
 import sys
+import threading
 
 from argparse import ArgumentParser
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from contextlib import nullcontext
+from multiprocessing import get_context
 from itertools import chain, zip_longest
-from PyQt6.QtCore import QTimer, Qt, QSize
+from typing import Hashable
+from PyQt6.QtCore import QObject, QTimer, Qt, QSize, pyqtSignal
 from PyQt6.QtGui import QFont, QPixmap
 from PyQt6.QtWidgets import *
 
+import matplotlib
+matplotlib.use('QtAgg')
+
 from Experiment import RWArgs, Experiment, Phase
-from Plots import show_plots, generate_figures
+from Plots import PhasePlot, show_plots, figure_colors
 from Environment import StimulusHistory
 from AdaptiveType import AdaptiveType
 from CoolTable import CoolTable
+from Cache import ResultCache
 
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
 from matplotlib import pyplot
 
+# Signals used to send the results of a simulation from its thread to the Qt thread.
+# All of them include the generation of the refresh that started the simulation.
+class SimulationSignals(QObject):
+    finished = pyqtSignal(int, object)
+    progress = pyqtSignal(int, int, int)
+    failed = pyqtSignal(int, object)
+
 class PavlovianApp(QDialog):
     adaptive_types: list[str]
     current_adaptive_type: str
 
-    figures: list[pyplot.Figure]
+    # Figures are only built when their phase is shown, and the phases next to it are
+    # built when the app is idle. figures[n] is the plot of phase n + 1, along with a
+    # key of the data it shows; its lines are only updated when that data changes.
+    figures: dict[int, tuple[Hashable, PhasePlot]]
+    pickableFigures: set[pyplot.Figure]
+    strengths: list[dict[str, StimulusHistory]]
+    colors: dict[str, tuple[float, float, float]]
+    plotOptions: dict[str, bool]
     phases: dict[str, list[Phase]]
     phaseNum: int
     numPhases: int
@@ -38,13 +59,36 @@ class PavlovianApp(QDialog):
 
     hidden: bool
     dpi: int
-    def __init__(self, dpi = 200, parent=None):
+
+    # Groups run in `jobs` processes when it's more than 1. The pool is kept between
+    # refreshes so that the workers only start once.
+    jobs: int
+    executor: None | ProcessPoolExecutor
+
+    # Results of every group, so that only the groups that changed are run again.
+    # The cache is shared with the simulation threads, so it's protected by a lock.
+    cache: ResultCache
+    cacheLock: threading.Lock
+
+    # Simulations run in a background thread. Each refresh increases the generation,
+    # and results of older generations are discarded.
+    refresh_delay = 250
+    generation: int
+    refreshTimer: QTimer
+    signals: SimulationSignals
+    lastArgs: None | RWArgs
+
+    def __init__(self, dpi = 200, jobs = 1, cache_size = 256, parent=None):
         super(PavlovianApp, self).__init__(parent)
 
         self.adaptive_types = AdaptiveType.types().keys()
         self.current_adaptive_type = None
 
-        self.figures = []
+        self.figures = {}
+        self.pickableFigures = set()
+        self.strengths = []
+        self.colors = {}
+        self.plotOptions = {}
         self.phases = {}
         self.phaseNum = 1
         self.numPhases = 0
@@ -57,6 +101,23 @@ class PavlovianApp(QDialog):
         self.hidden = False
         self.dpi = dpi
 
+        self.jobs = jobs
+        self.executor = None
+        self.cache = ResultCache(max_bytes = cache_size * 2**20)
+        self.cacheLock = threading.Lock()
+
+        self.generation = 0
+        self.lastArgs = None
+        self.refreshTimer = QTimer(self)
+        self.refreshTimer.setSingleShot(True)
+        self.refreshTimer.setInterval(self.refresh_delay)
+        self.refreshTimer.timeout.connect(self.startSimulation)
+
+        self.signals = SimulationSignals()
+        self.signals.finished.connect(self.showResults)
+        self.signals.progress.connect(self.showProgress)
+        self.signals.failed.connect(self.showError)
+
         self.initUI()
         QTimer.singleShot(100, self.updateWidgets)
 
@@ -91,11 +152,17 @@ class PavlovianApp(QDialog):
         phaseBoxLayout.addWidget(self.rightPhaseButton)
         self.phaseBox.setLayout(phaseBoxLayout)
 
+        self.progressBar = QProgressBar()
+        self.progressBar.setFormat('Simulating %v/%m groups')
+        self.progressBar.setVisible(False)
+
         plotBoxLayout = QVBoxLayout()
         plotBoxLayout.addWidget(self.plotCanvas)
         plotBoxLayout.addWidget(self.phaseBox)
+        plotBoxLayout.addWidget(self.progressBar)
         plotBoxLayout.setStretch(0, 1)
         plotBoxLayout.setStretch(1, 0)
+        plotBoxLayout.setStretch(2, 0)
         self.plotBox.setLayout(plotBoxLayout)
 
         self.adaptiveTypeButtons = self.addAdaptiveTypeButtons()
@@ -231,6 +298,13 @@ class PavlovianApp(QDialog):
         self.hideButton = QPushButton("Toggle Visibility")
         self.hideButton.clicked.connect(self.hideExperiment)
 
+        self.jobsBox = QSpinBox()
+        self.jobsBox.setPrefix('Jobs: ')
+        self.jobsBox.setRange(1, os.cpu_count() or 1)
+        self.jobsBox.setValue(self.jobs)
+        self.jobsBox.setToolTip('Amount of processes used to run the groups in parallel.')
+        self.jobsBox.valueChanged.connect(self.setJobs)
+
         phaseOptionsLayout = QVBoxLayout()
         phaseOptionsLayout.addWidget(self.toggleRandButton)
         phaseOptionsLayout.addWidget(self.phaseLambdaButton)
@@ -242,6 +316,7 @@ class PavlovianApp(QDialog):
         plotOptionsLayout.addWidget(self.refreshButton)
         plotOptionsLayout.addWidget(self.printButton)
         plotOptionsLayout.addWidget(self.hideButton)
+        plotOptionsLayout.addWidget(self.jobsBox)
         self.plotOptionsGroupBox.setLayout(plotOptionsLayout)
 
         fileOptionsLayout = QVBoxLayout()
@@ -250,6 +325,27 @@ class PavlovianApp(QDialog):
         fileOptionsLayout.addWidget(self.setDefaultParamsButton)
         self.fileOptionsGroupBox.setLayout(fileOptionsLayout)
 
+    def setJobs(self, jobs: int):
+        self.jobs = jobs
+        self.shutdownExecutor()
+        self.refreshExperiment()
+
+    # Return the process pool used to run the groups, starting it if needed.
+    def getExecutor(self) -> None | ProcessPoolExecutor:
+        if self.jobs <= 1:
+            return None
+
+        if self.executor is None:
+            # Use spawn, since forking a process that's running Qt is not safe.
+            self.executor = ProcessPoolExecutor(max_workers = self.jobs, mp_context = get_context('spawn'))
+
+        return self.executor
+
+    def shutdownExecutor(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait = False, cancel_futures = True)
+            self.executor = None
+
     def toggleRand(self):
         set_rand = any(p[self.phaseNum - 1].rand for p in self.phases.values())
         self.tableWidget.setRandInSelection(not set_rand)
@@ -371,6 +467,8 @@ If you have any questions, contact any of the authors.
             rho = "ρ ",
             nu = "ν ",
             num_trials = "Nº",
+            seed = "Sd",
+            tolerance = "SE",
         )
         
         descriptions = dict(
@@ -388,14 +486,18 @@ If you have any questions, contact any of the authors.
             gamma = "Weight parameter for past trials.",
             thetaE = "Excitory theta based on LePelley's model.",
             thetaI = "Inhibitory theta based on LePelley's model.",
-            num_trials = "Number of random trials per experiment.",
+            num_trials = "Number of random trials per experiment, or the maximum number if SE is set.",
+            seed = "Seed of the random trials. The same seed always gives the same results; leave it empty to use a different one on every run.",
+            tolerance = "Stop the random trials once the standard error of the average associative strength is below this at every step, running at most Nº of them. Leave it empty to always run Nº trials.",
         )
         params = QFormLayout()
         for key, val in AdaptiveType.initial_defaults().items():
-            label = self.DualLabel(short_names[key], self, str(val), hoverText = descriptions[key]).addRow(params)
+            label = self.DualLabel(short_names[key], self, '' if val is None else str(val), hoverText = descriptions[key]).addRow(params)
             setattr(self, key, label)
         self.num_trials.box.setGeometry(100, 120, 120, 60)
         self.num_trials.box.setDisabled(True)
+        self.seed.box.setDisabled(True)
+        self.tolerance.box.setDisabled(True)
 
         params.setLabelAlignment(Qt.AlignmentFlag.AlignRight)
         self.parametersGroupBox.setLayout(params)
@@ -487,14 +589,18 @@ If you have any questions, contact any of the authors.
         f = cls.floatOr(text)
         return f or 0
 
+    # Per-CS values of a parameter. CS without a value use the default value of the
+    # group; this is a plain dict so that it can be sent to other processes.
     def csPercDict(self, perc) -> dict[str, float]:
-        value = self.floatOrZero(getattr(self, perc).box.text())
         if not self.alphasBox.isVisible() or perc not in self.per_cs_param:
-            return defaultdict(lambda: value)
+            return {}
 
+        value = self.floatOrZero(getattr(self, perc).box.text())
         return {cs: self.floatOr(pair.box.text(), value) for cs, pair in self.per_cs_param[perc].items()}
 
-    def generateResults(self) -> tuple[list[dict[str, StimulusHistory]], dict[str, list[Phase]], RWArgs]:
+    # Read the experiments in the table and the parameters, returning None if there
+    # was a syntax error.
+    def readInputs(self) -> None | tuple[list[Experiment], RWArgs, int]:
         args = RWArgs(
             adaptive_type = self.current_adaptive_type,
 
@@ -526,6 +632,8 @@ If you have any questions, contact any of the authors.
 
             window_size = 1,
             num_trials = int(self.num_trials.box.text()),
+            seed = None if self.seed.box.text() == '' else int(self.seed.box.text()),
+            tolerance = self.floatOr(self.tolerance.box.text()),
 
             plot_alpha = self.plot_alpha and not AdaptiveType.types()[self.current_adaptive_type].should_plot_macknhall(),
             plot_macknhall = self.plot_alpha and AdaptiveType.types()[self.current_adaptive_type].should_plot_macknhall(),
@@ -536,8 +644,7 @@ If you have any questions, contact any of the authors.
         rowCount = self.tableWidget.rowCount()
         columnCount = self.tableWidget.columnCount()
 
-        strengths = [StimulusHistory.emptydict() for _ in range(columnCount)]
-        phases = dict()
+        experiments = []
         for row in range(rowCount):
             name = self.tableWidget.table.verticalHeaderItem(row).text()
             phase_strs = [self.tableWidget.getText(row, column) for column in range(columnCount)]
@@ -545,27 +652,133 @@ If you have any questions, contact any of the authors.
                 continue
 
             try:
-                experiment = Experiment(name, phase_strs)
+                experiments.append(Experiment(name, phase_strs))
             except ValueError as e:
                 QMessageBox.critical(self, 'Syntax Error', str(e))
+                return None
+
+        return experiments, args, columnCount
+
+    # Run the experiments, reusing the cached results of the groups that didn't change.
+    # This can run outside the Qt thread: it stops early and returns None when
+    # `cancelled` returns True, and calls `progress(done, total)` after each group.
+    def computeResults(self, experiments: list[Experiment], args: RWArgs, columnCount: int, cancelled = lambda: False, progress = None) -> None | tuple[list[dict[str, StimulusHistory]], dict[str, list[Phase]]]:
+        with self.cacheLock:
+            keys = [ResultCache.key(experiment, args) for experiment in experiments]
+            results = [self.cache.get(key) for key in keys]
+            missing = [e for e, result in enumerate(results) if result is None]
+            checkpoints = {e: self.cache.checkpoints(experiments[e], args) for e in missing}
+
+        if progress is not None:
+            progress(len(experiments) - len(missing), len(experiments))
+
+        def store(e, result, new_checkpoints):
+            with self.cacheLock:
+                self.cache.put(keys[e], result)
+                self.cache.put_checkpoints(experiments[e], args, new_checkpoints)
+
+            results[e] = result
+            if progress is not None:
+                progress(sum(r is not None for r in results), len(experiments))
+
+        # Groups that aren't cached are run from the checkpoint of the last phase that
+        # didn't change. Finished groups are cached even if this run is cancelled later.
+        executor = self.getExecutor()
+        if executor is None:
+            for e in missing:
+                if cancelled():
+                    return None
+
+                store(e, *experiments[e].run_from_checkpoints(args, checkpoints[e]))
+        else:
+            futures = {executor.submit(Experiment.run_from_checkpoints, experiments[e], args, checkpoints[e]): e for e in missing}
+            for future in as_completed(futures):
+                if cancelled():
+                    for f in futures:
+                        f.cancel()
+                    return None
 
-                # Apologies for the Go-like code. This should be a sum type!
-                return [], {}, args
-
-            local_strengths = experiment.run_all_phases(args)
+                store(futures[future], *future.result())
 
+        strengths = [StimulusHistory.emptydict() for _ in range(columnCount)]
+        phases = dict()
+        for experiment, local_strengths in zip(experiments, results):
             strengths = [a | b for a, b in zip_longest(strengths, local_strengths, fillvalue = StimulusHistory.emptydict())]
-            phases[name] = experiment.phases
+            phases[experiment.name] = experiment.phases
+
+        return strengths, phases
+
+    def generateResults(self) -> tuple[list[dict[str, StimulusHistory]], dict[str, list[Phase]], RWArgs]:
+        inputs = self.readInputs()
+        if inputs is None:
+            # Apologies for the Go-like code. This should be a sum type!
+            return [], {}, self.lastArgs
 
-        return strengths, phases, args
+        experiments, args, columnCount = inputs
+        self.lastArgs = args
 
+        results = self.computeResults(experiments, args, columnCount)
+        assert results is not None
+        return *results, args
+
+    # Refreshing is debounced: the simulation only starts once there were no more
+    # changes for `refresh_delay` milliseconds. Every refresh supersedes the previous
+    # ones, whose results are discarded.
     def refreshExperiment(self):
         self.tableWidget.updateSizes()
 
-        for fig in self.figures:
-            pyplot.close(fig)
+        self.generation += 1
+        self.refreshTimer.start()
 
-        strengths, phases, args = self.generateResults()
+    # Start running the simulation in a background thread; the results are received
+    # by showResults through a signal.
+    def startSimulation(self):
+        inputs = self.readInputs()
+        if inputs is None:
+            return
+
+        experiments, args, columnCount = inputs
+        self.lastArgs = args
+
+        generation = self.generation
+        self.progressBar.setRange(0, 0)
+        self.progressBar.setVisible(True)
+
+        def run():
+            try:
+                results = self.computeResults(
+                    experiments,
+                    args,
+                    columnCount,
+                    cancelled = lambda: generation != self.generation,
+                    progress = lambda done, total: self.signals.progress.emit(generation, done, total),
+                )
+            except Exception as e:
+                self.signals.failed.emit(generation, e)
+                return
+
+            if results is not None:
+                self.signals.finished.emit(generation, (*results, args))
+
+        threading.Thread(target = run, daemon = True).start()
+
+    def showProgress(self, generation: int, done: int, total: int):
+        if generation == self.generation:
+            self.progressBar.setRange(0, total)
+            self.progressBar.setValue(done)
+
+    def showError(self, generation: int, error: Exception):
+        if generation == self.generation:
+            self.progressBar.setVisible(False)
+            QMessageBox.critical(self, 'Error', str(error))
+
+    def showResults(self, generation: int, results: tuple[list[dict[str, StimulusHistory]], dict[str, list[Phase]], RWArgs]):
+        if generation != self.generation:
+            return
+
+        self.progressBar.setVisible(False)
+
+        strengths, phases, args = results
         if len(phases) == 0:
             self.refreshAlphasGroupBox(set())
             return
@@ -577,39 +790,106 @@ If you have any questions, contact any of the authors.
         self.phaseNum = min(self.phaseNum, self.numPhases)
         self.phases = phases
 
-        self.figures = generate_figures(
-            strengths,
+        self.strengths = strengths
+        self.colors = figure_colors(strengths)
+        self.plotOptions = dict(
             plot_alpha = args.plot_alpha and not AdaptiveType.types()[self.current_adaptive_type].should_plot_macknhall(),
             plot_macknhall = args.plot_macknhall and AdaptiveType.types()[self.current_adaptive_type].should_plot_macknhall(),
-            dpi = self.dpi,
-            ticker_threshold = True,
         )
-        for f in self.figures:
-            f.set_canvas(self.plotCanvas)
+
+        for index in [index for index in self.figures if index >= len(strengths)]:
+            self.closeFigure(self.figures.pop(index)[1].figure)
 
         self.refreshFigure()
 
+    # Returns the figure of a phase. If its data changed since it was last shown, its
+    # lines are updated in place; it's only built again if the plot options changed.
+    def phaseFigure(self, index: int) -> pyplot.Figure:
+        data = self.strengths[index]
+
+        # Groups that run again produce new histories even when their values don't change,
+        # so the histories are compared by their contents.
+        layout = (tuple(self.plotOptions.items()), self.dpi)
+        key = (layout, tuple((k, hash(hist.values.tobytes()), self.colors[k]) for k, hist in data.items()))
+
+        cached = self.figures.get(index)
+        if cached is not None:
+            cached_key, plot = cached
+            if cached_key == key:
+                return plot.figure
+
+            if cached_key[0] == layout:
+                # The legend and the layout only change when the series do.
+                if plot.update(data, self.colors):
+                    plot.figure.tight_layout()
+                if self.hidden:
+                    self.hideFigureLines(plot.figure)
+
+                self.figures[index] = (key, plot)
+                return plot.figure
+
+            self.closeFigure(plot.figure)
+
+        plot = PhasePlot(dpi = self.dpi, ticker_threshold = True, **self.plotOptions)
+        plot.update(data, self.colors)
+        plot.figure.tight_layout()
+        plot.figure.set_canvas(self.plotCanvas)
+        self.hideFigureLines(plot.figure)
+
+        self.figures[index] = (key, plot)
+        return plot.figure
+
+    def closeFigure(self, fig: pyplot.Figure):
+        self.pickableFigures.discard(fig)
+        pyplot.close(fig)
+
+    # Build the figures of the phases next to the current one, so that they can be
+    # shown without waiting.
+    def prerenderFigures(self):
+        for index in (self.phaseNum, self.phaseNum - 2):
+            if 0 <= index < len(self.strengths):
+                self.phaseFigure(index)
+
     def refreshFigure(self):
-        current_figure = self.figures[self.phaseNum - 1]
-        self.plotCanvas.figure = current_figure
+        current_figure = self.phaseFigure(self.phaseNum - 1)
+        if self.plotCanvas.figure is not current_figure:
+            self.plotCanvas.figure = current_figure
+
+            self.plotCanvas.resize(self.plotCanvas.width() + 1, self.plotCanvas.height() + 1)
+            self.plotCanvas.resize(self.plotCanvas.width() - 1, self.plotCanvas.height() - 1)
 
-        self.plotCanvas.resize(self.plotCanvas.width() + 1, self.plotCanvas.height() + 1)
-        self.plotCanvas.resize(self.plotCanvas.width() - 1, self.plotCanvas.height() - 1)
+            # The callbacks of the canvas are kept in its figure, so they're only connected once.
+            if current_figure not in self.pickableFigures:
+                self.plotCanvas.mpl_connect('pick_event', self.pickLine)
+                self.pickableFigures.add(current_figure)
 
-        self.plotCanvas.mpl_connect('pick_event', self.pickLine)
+            self.plotCanvas.draw()
+        else:
+            self.plotCanvas.draw_idle()
 
-        self.plotCanvas.draw()
         self.tableWidget.selectColumn(self.phaseNum - 1)
 
-        self.phaseInfo.setText(f'{self.phaseNum}/{self.numPhases}')
+        # Randomised phases show how many permutations were run, which can be fewer
+        # than Nº when they stop on a tolerance.
+        runs = sorted({hist.runs for hist in self.strengths[self.phaseNum - 1].values() if hist.runs is not None})
+        if not runs:
+            self.phaseInfo.setText(f'{self.phaseNum}/{self.numPhases}')
+        elif len(runs) == 1:
+            self.phaseInfo.setText(f'{self.phaseNum}/{self.numPhases} ({runs[0]} trials)')
+        else:
+            self.phaseInfo.setText(f'{self.phaseNum}/{self.numPhases} ({runs[0]}-{runs[-1]} trials)')
 
         any_rand = any(p[self.phaseNum - 1].rand for p in self.phases.values())
         self.num_trials.box.setDisabled(not any_rand)
+        self.seed.box.setDisabled(not any_rand)
+        self.tolerance.box.setDisabled(not any_rand)
         self.toggleRandButton.setChecked(any_rand)
 
         any_lambda = any(p[self.phaseNum - 1].lamda is not None for p in self.phases.values())
         self.phaseLambdaButton.setChecked(any_lambda)
 
+        QTimer.singleShot(0, self.prerenderFigures)
+
     def pickLine(self, event):
         line = event.artist
         label = line.get_label()
@@ -626,27 +906,29 @@ If you have any questions, contact any of the authors.
         line.figure.canvas.draw_idle()
 
     def hideLines(self):
-        for fig in self.figures:
-            for ax in fig.get_axes():
-                # Hide/show all lines in the plot
-                for line in ax.get_lines():
-                    if self.hidden:
-                        line.set_alpha(0)
-                    else:
-                        line.set_alpha(.5)
-                
-                # Hide/show all lines in the legend
-                legend = ax.get_legend()
-                if legend is not None:
-                    for legend_handle in legend.legend_handles:
-                        if self.hidden:
-                            legend_handle.set_alpha(.25)
-                        else:
-                            legend_handle.set_alpha(.5)
-            
+        for _, plot in self.figures.values():
+            self.hideFigureLines(plot.figure)
+
             # Redraw the figure
-            fig.canvas.draw_idle()
+            plot.figure.canvas.draw_idle()
 
+    def hideFigureLines(self, fig: pyplot.Figure):
+        for ax in fig.get_axes():
+            # Hide/show all lines in the plot
+            for line in ax.get_lines():
+                if self.hidden:
+                    line.set_alpha(0)
+                else:
+                    line.set_alpha(.5)
+
+            # Hide/show all lines in the legend
+            legend = ax.get_legend()
+            if legend is not None:
+                for legend_handle in legend.legend_handles:
+                    if self.hidden:
+                        legend_handle.set_alpha(.25)
+                    else:
+                        legend_handle.set_alpha(.5)
 
     def plotExperiment(self):
         strengths, phases, args = self.generateResults()
@@ -691,6 +973,8 @@ def parse_args():
     args = ArgumentParser('Display a GUI for simulating models.')
     args.add_argument('--dpi', type = int, default = 200, help = 'DPI for shown and outputted figures.')
     args.add_argument('--debug', action = 'store_true', help = 'Whether to go to a debugging console if there is an exception')
+    args.add_argument('--jobs', type = int, default = 1, help = 'Amount of processes used to run the groups in parallel.')
+    args.add_argument('--cache-size', type = int, default = 256, help = 'Maximum memory, in MiB, used to keep the results of groups that did not change.')
     args.add_argument('load_file', nargs = '?', help = 'File to load initially')
     return args.parse_args()
 
@@ -698,14 +982,16 @@ def main():
     args = parse_args()
 
     app = QApplication(sys.argv)
-    gallery = PavlovianApp(dpi = args.dpi)
+    gallery = PavlovianApp(dpi = args.dpi, jobs = args.jobs, cache_size = args.cache_size)
     gallery.show()
 
     if args.load_file:
         gallery.loadFile(args.load_file)
         gallery.refreshExperiment()
 
-    sys.exit(app.exec())
+    code = app.exec()
+    gallery.shutdownExecutor()
+    sys.exit(code)
 
 if __name__ == '__main__':
     main()
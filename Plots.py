@@ -1,14 +1,21 @@
 from __future__ import annotations
 
 import re
-import seaborn
 import matplotlib
-matplotlib.use('QtAgg')
+import numpy as np
+import seaborn
 
+# The backend is chosen by whoever imports this module: Qt when showing figures,
+# and Agg when only saving them, so that no display is needed.
 from matplotlib import pyplot
 from Environment import StimulusHistory
+from matplotlib.lines import Line2D
 from matplotlib.ticker import MaxNLocator
+from concurrent.futures import Executor, ProcessPoolExecutor
 from itertools import chain
+from multiprocessing import get_context
+from types import SimpleNamespace
+from typing import Any
 
 from Experiment import Phase
 
@@ -41,45 +48,91 @@ def titleify(filename: str, phases: dict[str, list[Phase]], phase_num: int, suff
 
     return '\n'.join(titles)
 
-def generate_figures(data: list[dict[str, StimulusHistory]], *, phases: None | dict[str, list[Phase]] = None, filename = None, plot_phase = None, plot_alpha = False, plot_macknhall = False, title_suffix = None, dpi = None, ticker_threshold = 10) -> list[pyplot.Figure]:
-    seaborn.set()
+# Color of every CS of every phase, which is the same in all the figures.
+def figure_colors(data: list[dict[str, StimulusHistory]]) -> dict[str, tuple[float, float, float]]:
+    experiment_css = sorted(set(chain.from_iterable([x.keys() for x in data])))
+    return dict(zip(experiment_css, seaborn.color_palette('husl', len(experiment_css))))
 
-    if plot_phase is not None:
-        data = [data[plot_phase - 1]]
+# Series with more points than this are drawn without markers.
+marker_threshold = 250
 
-    experiment_css = sorted(set(chain.from_iterable([x.keys() for x in data])))
-    colors = dict(zip(experiment_css, seaborn.color_palette('husl', len(experiment_css))))
+# Downsample values[start:stop] to the minimum and the maximum of at most `buckets`
+# consecutive buckets, along with the first and last values. Unlike averaging, this
+# keeps the peaks and the range of the curve, so it looks the same when every bucket
+# is a single pixel wide. Returns the indices and the values of the kept points.
+def decimate(values: np.ndarray, buckets: int, start: int = 0, stop: None | int = None) -> tuple[np.ndarray, np.ndarray]:
+    start = max(start, 0)
+    stop = len(values) if stop is None else min(max(stop, start), len(values))
+
+    y = values[start:stop]
+    if len(y) <= 2 * buckets:
+        return np.arange(start, stop), y
+
+    size = -(-len(y) // buckets)
+    rows = -(-len(y) // size)
+    padded = np.full(rows * size, np.nan)
+    padded[:len(y)] = y
+    padded = padded.reshape(rows, size)
+
+    offsets = np.arange(rows) * size
+    lows = offsets + np.where(np.isnan(padded), np.inf, padded).argmin(axis = 1)
+    highs = offsets + np.where(np.isnan(padded), -np.inf, padded).argmax(axis = 1)
+    index = np.unique(np.concatenate([lows, highs, [0, len(y) - 1]]))
+
+    return start + index, y[index]
+
+# PhasePlot is the figure of a single phase. It keeps the line of every series,
+# so that when the data changes the existing lines are updated in place, and only
+# the series that appeared or disappeared are added or removed.
+#
+# Long series are decimated to the width of their axes in pixels, and decimated
+# again from the full values of the visible range whenever the axes are zoomed.
+class PhasePlot:
+    figure: pyplot.Figure
+    axes: list[pyplot.Axes]
+
+    plot_alpha: bool
+    plot_macknhall: bool
+    ticker_threshold: float | bool
+
+    # lines[axis, label] is the line of a series, and labels[axis] are the labels of
+    # the axis in the order they are shown in its legend. values[axis, label] and
+    # markers[axis, label] are the full values and the marker of the series.
+    lines: dict[tuple[int, str], Line2D]
+    labels: list[list[str]]
+    values: dict[tuple[int, str], np.ndarray]
+    markers: dict[tuple[int, str], str]
+
+    def __init__(self, *, plot_alpha = False, plot_macknhall = False, dpi = None, ticker_threshold = 10):
+        seaborn.set()
+
+        self.plot_alpha = plot_alpha
+        self.plot_macknhall = plot_macknhall
+        self.ticker_threshold = ticker_threshold
+        self.lines = {}
+        self.values = {}
+        self.markers = {}
 
-    figures = []
-    for phase_num, experiments in enumerate(data, start = 1):
         if not plot_alpha and not plot_macknhall:
             fig, axes_ = pyplot.subplots(1, 1, figsize = (8, 4), dpi = dpi)
             axes = [axes_]
         else:
             fig, axes = pyplot.subplots(1, 2, figsize = (16, 6), dpi = dpi)
 
-        for key, hist in experiments.items():
-            line = axes[0].plot(hist.assoc, label=key, marker='D', color = colors[key], markersize=4, alpha=.5, picker = ticker_threshold)
-
-            if len(axes) > 1:
-                if plot_alpha and not plot_macknhall:
-                    axes[1].plot(hist.alpha, label='α: '+str(key), color = colors[key], marker='D', markersize=4, alpha=.5, picker = ticker_threshold)
-                #else:
-                    #axes[1].plot([], label=key, color = colors[key], marker='D', markersize=8, alpha=.5, picker = ticker_threshold)
+        self.figure = fig
+        self.axes = list(axes)
+        self.labels = [[] for _ in self.axes]
 
-                if plot_macknhall:
-                    axes[1].plot(hist.alpha_mack, label='Mack: ' + str(key), color = colors[key], marker='$M$', markersize=4, alpha=.5, picker = ticker_threshold)
-                    axes[1].plot(hist.alpha_hall, label='Hall: ' + str(key), color = colors[key], marker='$H$', markersize=4, alpha=.5, picker = ticker_threshold)
+        # Callbacks only keep weak references to methods, but the plot should live as
+        # long as its figure even if only the figure is kept.
+        for ax in self.axes:
+            ax.callbacks.connect('xlim_changed', lambda ax: self.zoom(ax))
 
         axes[0].set_xlabel('Trial Number', fontsize = 'small', labelpad = 3)
         axes[0].set_ylabel('Associative Strength', fontsize = 'small', labelpad = 3)
         axes[0].xaxis.set_major_locator(MaxNLocator(integer = True))
         axes[0].tick_params(axis = 'both', labelsize = 'x-small', pad = 1)
         axes[0].ticklabel_format(useOffset = False, style = 'plain', axis = 'y')
-        if len(experiments) >= 6:
-            axes[0].legend(fontsize = 5, ncol = 2).set_draggable(True)
-        else:
-            axes[0].legend(fontsize = 'x-small').set_draggable(True)
 
         if plot_alpha or plot_macknhall:
             axes[0].set_title(f'Associative Strengths')
@@ -91,25 +144,128 @@ def generate_figures(data: list[dict[str, StimulusHistory]], *, phases: None | d
             axes[1].tick_params(axis = 'both', labelsize = 'x-small', pad = 1)
             axes[1].tick_params(axis = 'y', which = 'both', right = True, length = 0)
             axes[1].yaxis.set_label_position('right')
-            if len(experiments) >= 6:
-                axes[1].legend(fontsize = 5, ncol = 2).set_draggable(True)
+
+    # Every series of a phase, as tuples of (axis, label, values, color, marker).
+    def series(self, experiments: dict[str, StimulusHistory], colors: dict[str, tuple[float, float, float]]) -> list[tuple[int, str, np.ndarray, tuple[float, float, float], str]]:
+        series = []
+        for key, hist in experiments.items():
+            series.append((0, key, hist.assoc, colors[key], 'D'))
+
+            if len(self.axes) > 1:
+                if self.plot_alpha and not self.plot_macknhall:
+                    series.append((1, 'α: '+str(key), hist.alpha, colors[key], 'D'))
+
+                if self.plot_macknhall:
+                    series.append((1, 'Mack: ' + str(key), hist.alpha_mack, colors[key], '$M$'))
+                    series.append((1, 'Hall: ' + str(key), hist.alpha_hall, colors[key], '$H$'))
+
+        return series
+
+    # Show new data, returning whether the set of series changed. Lines that already
+    # existed keep their alpha, so lines hidden by the user stay hidden.
+    def update(self, experiments: dict[str, StimulusHistory], colors: dict[str, tuple[float, float, float]]) -> bool:
+        labels = [[] for _ in self.axes]
+        for axis, label, values, color, marker in self.series(experiments, colors):
+            labels[axis].append(label)
+
+            line = self.lines.get((axis, label))
+            if line is None:
+                [line] = self.axes[axis].plot([], [], label = label, marker = marker, color = color, markersize = 4, alpha = .5, picker = self.ticker_threshold)
+                self.lines[axis, label] = line
             else:
-                axes[1].legend(fontsize = 'x-small').set_draggable(True)
+                line.set_color(color)
 
-        legend_lines = chain.from_iterable([ax.get_legend().get_lines() for ax in axes])
-        for legend_line in legend_lines:
-            legend_line.set_picker(ticker_threshold)
+            self.values[axis, label] = values
+            self.markers[axis, label] = marker
+            self.set_line_data(axis, label)
 
-        if phases is not None:
-            fig.suptitle(titleify(filename, phases, phase_num, title_suffix), fontdict = {'family': 'monospace'}, fontsize = 12)
+        for (axis, label), line in list(self.lines.items()):
+            if label not in labels[axis]:
+                line.remove()
+                del self.lines[axis, label]
+                del self.values[axis, label]
+                del self.markers[axis, label]
 
-            if len(axes) > 1:
-                fig.subplots_adjust(top = .85)
+        for ax in self.axes:
+            ax.relim()
+            ax.autoscale_view()
 
-        fig.tight_layout()
-        figures.append(fig)
+        changed = labels != self.labels
+        if changed:
+            self.labels = labels
+            for axis, ax in enumerate(self.axes):
+                self.legend(ax, [self.lines[axis, label] for label in labels[axis]])
 
-    return figures
+        return changed
+
+    # Show the values of a series between the x limits, or all of them. The decimated
+    # values keep the minimum and maximum of the whole range, so autoscaling still
+    # fits every value.
+    def set_line_data(self, axis: int, label: str, xlim: None | tuple[float, float] = None):
+        values = self.values[axis, label]
+        start, stop = 0, len(values)
+        if xlim is not None:
+            # Include a point past each limit, so that the line reaches the edges.
+            start, stop = int(np.floor(min(xlim))), int(np.ceil(max(xlim))) + 1
+
+        x, y = decimate(values, max(int(self.axes[axis].bbox.width), 1), start, stop)
+
+        line = self.lines[axis, label]
+        line.set_data(x, y)
+        line.set_marker(self.markers[axis, label] if len(x) <= marker_threshold else '')
+
+    def zoom(self, ax: pyplot.Axes):
+        axis = self.axes.index(ax)
+        for other_axis, label in self.lines:
+            if other_axis == axis:
+                self.set_line_data(axis, label, ax.get_xlim())
+
+    def legend(self, ax: pyplot.Axes, lines: list[Line2D]):
+        if len(lines) >= 6:
+            legend = ax.legend(handles = lines, fontsize = 5, ncol = 2)
+        else:
+            legend = ax.legend(handles = lines, fontsize = 'x-small')
+
+        legend.set_draggable(True)
+        for legend_line in legend.get_lines():
+            legend_line.set_picker(self.ticker_threshold)
+
+# Build the figure of a single phase.
+def generate_figure(experiments: dict[str, StimulusHistory], colors: dict[str, tuple[float, float, float]], phase_num: int, *, phases: None | dict[str, list[Phase]] = None, filename = None, plot_alpha = False, plot_macknhall = False, title_suffix = None, dpi = None, ticker_threshold = 10) -> pyplot.Figure:
+    plot = PhasePlot(plot_alpha = plot_alpha, plot_macknhall = plot_macknhall, dpi = dpi, ticker_threshold = ticker_threshold)
+    plot.update(experiments, colors)
+
+    fig = plot.figure
+    if phases is not None:
+        fig.suptitle(titleify(filename, phases, phase_num, title_suffix), fontdict = {'family': 'monospace'}, fontsize = 12)
+
+        if len(plot.axes) > 1:
+            fig.subplots_adjust(top = .85)
+
+    fig.tight_layout()
+
+    return fig
+
+def generate_figures(data: list[dict[str, StimulusHistory]], *, phases: None | dict[str, list[Phase]] = None, filename = None, plot_phase = None, plot_alpha = False, plot_macknhall = False, title_suffix = None, dpi = None, ticker_threshold = 10) -> list[pyplot.Figure]:
+    if plot_phase is not None:
+        data = [data[plot_phase - 1]]
+
+    colors = figure_colors(data)
+    return [
+        generate_figure(
+            experiments,
+            colors,
+            phase_num,
+            phases = phases,
+            filename = filename,
+            plot_alpha = plot_alpha,
+            plot_macknhall = plot_macknhall,
+            title_suffix = title_suffix,
+            dpi = dpi,
+            ticker_threshold = ticker_threshold,
+        )
+        for phase_num, experiments in enumerate(data, start = 1)
+    ]
 
 def show_plots(data: list[dict[str, StimulusHistory]], *, phases: None | dict[str, list[Phase]] = None, plot_phase = None, plot_alpha = False, plot_macknhall = False, dpi = None):
     figures = generate_figures(
@@ -123,20 +279,87 @@ def show_plots(data: list[dict[str, StimulusHistory]], *, phases: None | dict[st
     )
     return figures
 
-def save_plots(data: list[dict[str, StimulusHistory]], *, phases: None | dict[str, list[Phase]] = None, filename: None | str = None, plot_phase = None, plot_alpha = False, plot_macknhall = False, title_suffix = None, dpi = None):
+# Values that are plotted from each history.
+plot_fields = ('assoc', 'alpha', 'alpha_mack', 'alpha_hall')
+
+# Only the plotted values of each history of a phase, as an array of shape (fields, steps).
+# This is much cheaper to send to other processes than the whole histories.
+def compact_phase(experiments: dict[str, StimulusHistory]) -> dict[str, np.ndarray]:
+    rows = [StimulusHistory.index[field] for field in plot_fields]
+    return {key: np.ascontiguousarray(hist.values[rows, :len(hist)]) for key, hist in experiments.items()}
+
+def expand_phase(experiments: dict[str, np.ndarray]) -> dict[str, SimpleNamespace]:
+    return {key: SimpleNamespace(**dict(zip(plot_fields, values))) for key, values in experiments.items()}
+
+# A figure to be saved: its path, and the arguments of generate_figure with the
+# compact values of its phase.
+FigureTask = tuple[str, dict[str, Any]]
+
+def figure_tasks(data: list[dict[str, StimulusHistory]], *, phases: None | dict[str, list[Phase]] = None, filename: None | str = None, plot_phase = None, plot_alpha = False, plot_macknhall = False, title_suffix = None, dpi = None) -> list[FigureTask]:
     if filename is not None:
         filename = filename.removesuffix('.png')
 
-    figures = generate_figures(
-        data = data,
+    if plot_phase is not None:
+        data = [data[plot_phase - 1]]
+
+    colors = figure_colors(data)
+    return [
+        (
+            f'{filename}_{phase_num}.png',
+            dict(
+                experiments = compact_phase(experiments),
+                colors = colors,
+                phase_num = phase_num,
+                phases = phases,
+                filename = filename,
+                plot_alpha = plot_alpha,
+                plot_macknhall = plot_macknhall,
+                title_suffix = title_suffix,
+                dpi = dpi,
+            ),
+        )
+        for phase_num, experiments in enumerate(data, start = 1)
+    ]
+
+def save_figure(path: str, kwargs: dict[str, Any]):
+    kwargs = dict(kwargs, experiments = expand_phase(kwargs['experiments']))
+    fig = generate_figure(**kwargs)
+    fig.savefig(path, dpi = kwargs['dpi'] or 150, bbox_inches = 'tight')
+    pyplot.close(fig)
+
+# Pool of processes to save figures. Figures are only saved, so they use Agg. The
+# workers are spawned, since the font caches of FreeType break when forked.
+def plot_executor(jobs: None | int = None) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers = jobs, mp_context = get_context('spawn'), initializer = matplotlib.use, initargs = ('Agg',))
+
+# Save several figures, possibly of different experiments, in an executor created
+# by plot_executor, or in this process if it's None.
+def save_figures(tasks: list[FigureTask], executor: None | Executor = None):
+    if executor is None:
+        for path, kwargs in tasks:
+            save_figure(path, kwargs)
+        return
+
+    for future in [executor.submit(save_figure, path, kwargs) for path, kwargs in tasks]:
+        future.result()
+
+# Save the figure of every phase to "{filename}_{phase}.png". With `jobs`, the figures
+# are rendered in that many processes (every core if it's 0).
+def save_plots(data: list[dict[str, StimulusHistory]], *, phases: None | dict[str, list[Phase]] = None, filename: None | str = None, plot_phase = None, plot_alpha = False, plot_macknhall = False, title_suffix = None, dpi = None, jobs: None | int = None):
+    tasks = figure_tasks(
+        data,
         phases = phases,
+        filename = filename,
         plot_phase = plot_phase,
         plot_alpha = plot_alpha,
         plot_macknhall = plot_macknhall,
-        filename = filename,
         title_suffix = title_suffix,
         dpi = dpi,
     )
 
-    for phase_num, fig in enumerate(figures, start = 1):
-        fig.savefig(f'{filename}_{phase_num}.png', dpi = dpi or 150, bbox_inches = 'tight')
+    if jobs is None or jobs == 1 or len(tasks) <= 1:
+        save_figures(tasks)
+        return
+
+    with plot_executor(min(jobs or len(tasks), len(tasks))) as executor:
+        save_figures(tasks, executor)
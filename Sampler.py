@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+from typing import Type
+
+import numpy as np
+
+# Returns the stream of random numbers of a single permutation of a randomised phase.
+# Philox is a counter-based generator, so every permutation has its own independent
+# stream derived from the seed of the phase and its index: the permutations are the
+# same regardless of the order, the process, or the batch they are run in.
+def permutation_rng(seed: np.random.SeedSequence, permutation: int) -> np.random.Generator:
+    return np.random.Generator(np.random.Philox(np.random.SeedSequence(seed.entropy, spawn_key = (*seed.spawn_key, permutation))))
+
+# Draws a uniformly random order of a multiset where index `i` appears `counts[i]` times.
+# The whole order is drawn at once: it takes 8 bytes per trial, which Kernel needs
+# anyway as its orders, and the samplers need every position to rearrange them.
+def random_order(counts: list[int], rng: np.random.Generator) -> np.ndarray:
+    return rng.permutation(np.repeat(np.arange(len(counts)), counts))
+
+# A sampler chooses the orders of the trials of the permutations of a randomised
+# phase, where an order is an array with the index of the distinct part of each
+# trial, and part `i` appears `counts[i]` times.
+#
+# Permutations are drawn in groups of `group_size` consecutive ones, and group `g`
+# uses the stream permutation_rng(seed, g). Every permutation is uniformly random by
+# itself, so the average of many of them converges to the same curve with every
+# sampler. However, the permutations of a group are chosen together so that their
+# errors cancel out, and fewer of them are needed for the same precision. Only
+# permutations of different groups are independent.
+#
+# The base class draws independent random permutations.
+class Sampler:
+    group_size: int = 1
+
+    @classmethod
+    def types(cls) -> dict[str, Type[Sampler]]:
+        return {
+            'random': Sampler,
+            'antithetic': AntitheticSampler,
+            'stratified': StratifiedSampler,
+            'latin': LatinSampler,
+        }
+
+    @classmethod
+    def get(cls, sampler_name: str) -> Sampler:
+        return cls.types()[sampler_name]()
+
+    # Orders of the permutations of a group, as an array of shape (group_size, trials).
+    def groupOrders(self, counts: list[int], rng: np.random.Generator) -> np.ndarray:
+        return random_order(counts, rng)[None]
+
+    # Orders of the permutations `start` to `start + rows - 1`, as an array of shape
+    # (rows, trials). They're the same regardless of how the permutations are split.
+    def orders(self, counts: list[int], seed: np.random.SeedSequence, start: int, rows: int) -> np.ndarray:
+        first = start // self.group_size
+        last = (start + rows - 1) // self.group_size
+
+        orders = np.concatenate([self.groupOrders(counts, permutation_rng(seed, group)) for group in range(first, last + 1)])
+        offset = start - first * self.group_size
+        return orders[offset:offset + rows]
+
+# Pairs of a random permutation and its reverse, so that trials that come early in
+# one of them come late in the other.
+class AntitheticSampler(Sampler):
+    group_size = 2
+
+    def groupOrders(self, counts: list[int], rng: np.random.Generator) -> np.ndarray:
+        order = random_order(counts, rng)
+        return np.stack([order, order[::-1]])
+
+# A random permutation is the order of a random key of each trial. Here the keys of
+# each trial are stratified over the group: exactly one permutation has the key of
+# the trial in each of `group_size` equal intervals, so over the group every trial
+# is spread evenly between the start and the end of the phase.
+class StratifiedSampler(Sampler):
+    group_size = 10
+
+    def groupOrders(self, counts: list[int], rng: np.random.Generator) -> np.ndarray:
+        parts = np.repeat(np.arange(len(counts)), counts)
+        strata = rng.permuted(np.repeat(np.arange(self.group_size)[:, None], len(parts), axis = 1), axis = 0)
+        keys = (strata + rng.random(strata.shape)) / self.group_size
+
+        return parts[np.argsort(keys, axis = 1)]
+
+# Rotations of a random permutation by multiples of 1/group_size of the phase, like
+# the rows of a Latin square: over the group, every section of the phase has each
+# part the same amount of times.
+class LatinSampler(Sampler):
+    group_size = 10
+
+    def groupOrders(self, counts: list[int], rng: np.random.Generator) -> np.ndarray:
+        order = random_order(counts, rng)
+        shifts = np.arange(self.group_size) * len(order) // self.group_size
+
+        return np.stack([np.roll(order, -shift) for shift in shifts])
@@ -1,15 +1,17 @@
 from __future__ import annotations
 
 import argparse
-import random
 import re
 import sys
-from collections import defaultdict
-from Experiment import Experiment, Phase
-from Group import Group
-from Environment import Environment, StimulusHistory
-from Plots import show_plots, save_plots
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from Experiment import Experiment, Phase, iter_experiments
+from Export import open_export
+from Sweep import run_sweep
+from Environment import StimulusHistory
 from AdaptiveType import AdaptiveType
+from Sampler import Sampler
 
 # Given a list of arguments, matches the ones corresponding to a particular name
 # combined with a CS and returns them as a dictionary, along with the remaining
@@ -27,6 +29,17 @@ def match_args(name: str, args: list[str]) -> tuple[dict[str, float], list[str]]
 
     return values, rest
 
+# Print the amount of permutations done in each randomised phase of every group, as
+# the groups finish.
+def report_permutations(experiments: list[Experiment], results: Iterator[list[dict[str, StimulusHistory]]]) -> Iterator[list[dict[str, StimulusHistory]]]:
+    for experiment, strengths in zip(experiments, results):
+        for phase_num, phase_strengths in enumerate(strengths, start = 1):
+            runs = {hist.runs for hist in phase_strengths.values() if hist.runs is not None}
+            if runs:
+                print(f'{experiment.name}, phase {phase_num}: {max(runs)} trials', file = sys.stderr)
+
+        yield strengths
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Behold! My Rescorla-Wagnerinator!",
@@ -40,7 +53,7 @@ def parse_args() -> argparse.Namespace:
 ''',
     )
 
-    parser.add_argument("--adaptive-type", choices = AdaptiveType.types().keys(), default = 'rescorla_wagner', help = 'Type of adaptive attention mode to use')
+    parser.add_argument("--adaptive-type", choices = AdaptiveType.types().keys(), default = 'Rescorla Wagner', help = 'Type of adaptive attention mode to use')
 
     parser.add_argument('--alpha', type = float, default = .1, help = 'Alpha for all other stimuli')
     parser.add_argument('--alpha-mack', type = float, help = 'Alpha_mack for all other stimuli')
@@ -50,6 +63,9 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--beta-neg", type = float, default = .2, help="Associativity of the absence of US +. Equal to beta by default.")
     parser.add_argument("--lamda", type = float, default = 1, help="Asymptote of learning.")
     parser.add_argument("--gamma", type = float, default = .5, help = "Weighting how much you rely on past experinces on DualV adaptive type.")
+    parser.add_argument("--kay", type = float, default = 2, help = "Constant for the hybrid model.")
+    parser.add_argument("--rho", type = float, default = .2, help = "Rho parameter for the MLAB hybrid model.")
+    parser.add_argument("--nu", type = float, default = .25, help = "Nu parameter for the MLAB hybrid model.")
 
     parser.add_argument("--thetaE", type = float, default = .2, help = "Theta for excitatory phenomena in LePelley blocking")
     parser.add_argument("--thetaI", type = float, default = .1, help = "Theta for inhibitory phenomena in LePelley blocking")
@@ -61,7 +77,18 @@ def parse_args() -> argparse.Namespace:
 
     parser.add_argument("--xi-hall", type = float, default = 0.2, help = 'Xi parameter for Hall alpha calculation')
 
-    parser.add_argument("--num-trials", type = int, default = 1000, help = 'Amount of trials done in randomised phases')
+    parser.add_argument("--num-trials", type = int, default = 1000, help = 'Amount of trials done in randomised phases, or the maximum amount if --tolerance is given')
+    parser.add_argument('--tolerance', type = float, help = 'Stop randomised phases once the standard error of the average associative strength is below this at every step. The amount of trials done in each one is printed to stderr.')
+    parser.add_argument('--sampler', choices = Sampler.types().keys(), default = 'random', help = 'How the permutations of randomised phases are chosen. "random" draws them independently; "antithetic" pairs each one with its reverse; "stratified" and "latin" spread every trial evenly over the phase across groups of permutations, which needs several times fewer permutations for the same precision.')
+    parser.add_argument('--seed', type = int, help = 'Seed of the randomised phases. Runs with the same seed give the same results. By default, a different seed is used on every run.')
+    parser.add_argument('--engine', choices = ['array', 'object'], default = 'array', help = 'Simulation engine. "array" runs randomised phases and phases with many CS of the supported adaptive types as numpy arrays; "object" runs each stimulus separately.')
+    parser.add_argument('--jobs', type = int, help = 'Amount of processes used to run the groups of the experiment file in parallel and to save their figures, or to run the points of a sweep. 0 uses every core. By default, use a single process except in sweeps, which use every core.')
+
+    parser.add_argument('--sweep', action = 'append', metavar = 'FIELD=SPEC', help = 'Instead of plotting, run every combination of values of the swept parameters and output a CSV table. FIELD is a parameter such as "alpha", "beta_neg", "adaptive_type", or "alpha_A"; SPEC is a comma-separated list of values or an inclusive range "start:stop:step". The table has a column "param_FIELD" with the value of each swept parameter. Can be repeated.')
+    parser.add_argument('--sweep-steps', type = lambda x: [int(y) for y in x.split(',')], default = [-1], help = 'Comma-separated list of steps of each phase to output in a sweep, where negative steps count from the end. By default, only the last one.')
+    parser.add_argument('--sweep-output', type = argparse.FileType('w'), default = sys.stdout, help = 'File where the sweep table is written. By default, standard output.')
+
+    parser.add_argument('--output', help = 'Write the values of every group, phase, CS, and trial to this file, which should end in .csv or .npz, or be "-" to write a CSV table to standard output. The CS of randomised phases also have the variance of their permutations, in the "_var" columns or arrays. Unless --savefig is also given, nothing is plotted.')
 
     parser.add_argument('--plot-phase', type = int, help = 'Plot a single phase')
     parser.add_argument("--plot-experiments", nargs = '*', help = 'List of experiments to plot. By default plot everything')
@@ -109,7 +136,7 @@ def main() -> None:
 
     groups_strengths = None
 
-    phases: dict[str, list[Phase]] = dict()
+    experiments: list[Experiment] = []
     for e, experiment in enumerate(args.experiment_file.readlines()):
         name, *phase_strs = experiment.strip().split('|')
         name = name.strip()
@@ -120,13 +147,56 @@ def main() -> None:
         if args.plot_experiments is not None and name not in args.plot_experiments:
             continue
 
-        experiment = Experiment(name, phase_strs)
-        local_strengths = experiment.run_all_phases(args)
-        groups_strengths = [a | b for a, b in zip(groups_strengths, local_strengths)]
-        phases[name] = experiment.phases
+        experiments.append(Experiment(name, phase_strs))
 
     assert(groups_strengths is not None)
 
+    # The experiment and output files can't be sent to other processes.
+    run_args = argparse.Namespace(**{k: v for k, v in vars(args).items() if k not in ('experiment_file', 'sweep_output')})
+    if args.sweep:
+        run_sweep(experiments, run_args, args.sweep, args.sweep_steps, args.sweep_output, jobs = args.jobs or None)
+        return
+
+    executor = None
+    if args.jobs is not None and args.jobs != 1:
+        executor = ProcessPoolExecutor(max_workers = args.jobs or None)
+
+    with executor or nullcontext():
+        results = iter_experiments(experiments, run_args, executor)
+        if args.tolerance is not None:
+            results = report_permutations(experiments, results)
+
+        if args.output is None:
+            results = list(results)
+        else:
+            # Groups are written as they finish, and only kept if they are also plotted.
+            export = open_export(args.output)
+            kept = []
+            try:
+                for experiment, strengths in zip(experiments, results):
+                    export.write_group(experiment.name, strengths)
+                    if args.savefig is not None:
+                        kept.append(strengths)
+            finally:
+                export.close()
+
+            if args.savefig is None:
+                return
+
+            results = kept
+
+    # Results are merged in the same order as the experiment file.
+    phases: dict[str, list[Phase]] = dict()
+    for experiment, local_strengths in zip(experiments, results):
+        groups_strengths = [a | b for a, b in zip(groups_strengths, local_strengths)]
+        phases[experiment.name] = experiment.phases
+
+    # Plotting imports are slow, so they're only loaded when plotting. Saved figures
+    # are drawn with Agg, which doesn't need Qt or a display.
+    import matplotlib
+    matplotlib.use('QtAgg' if args.savefig is None else 'Agg')
+    from Plots import show_plots, save_plots
+
     if args.savefig is None:
         figures = show_plots(
             groups_strengths,
@@ -146,7 +216,8 @@ def main() -> None:
             plot_phase = args.plot_phase,
             plot_alpha = args.plot_alpha,
             plot_macknhall = args.plot_macknhall,
-            title_suffix = args.title_suffix
+            title_suffix = args.title_suffix,
+            jobs = args.jobs,
         )
 
 if __name__ == '__main__':
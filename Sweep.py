@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import re
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import fields
+from itertools import product, repeat
+from typing import Any, TextIO
+
+from AdaptiveType import AdaptiveType
+from Environment import Stimulus
+from Experiment import Experiment, RWArgs, run_experiments
+from Sampler import Sampler
+
+# A sweep runs the same experiments for every combination of several values of
+# the arguments, and returns the values of every CS at some steps of each phase.
+#
+# Every swept parameter is written as FIELD=SPEC, where FIELD is any field of RWArgs
+# (for example, `alpha`, `beta_neg`, or `adaptive_type`) or a per-CS parameter
+# (for example, `alpha_A` or `salience_B`), and SPEC is either a list of values
+# separated by commas (`0.1,0.2,0.5`) or an inclusive range `start:stop:step` (`0.1:0.5:0.1`).
+
+# Per-CS parameters, and the field of RWArgs where they are stored.
+per_cs_fields = {
+    'alpha': 'alphas',
+    'alpha_mack': 'alpha_macks',
+    'alpha_hall': 'alpha_halls',
+    'salience': 'saliences',
+    'habituation': 'habituations',
+}
+
+def parse_value(field: str, value: str) -> Any:
+    if field in per_cs_fields.values():
+        return float(value)
+
+    kind = {f.name: str(f.type) for f in fields(RWArgs)}[field]
+    if field == 'adaptive_type' and value not in AdaptiveType.types():
+        raise ValueError(f'Unknown adaptive type "{value}"')
+    if field == 'sampler' and value not in Sampler.types():
+        raise ValueError(f'Unknown sampler "{value}"')
+    if kind == 'str':
+        return value
+    if kind in ('int', 'None | int'):
+        return int(value)
+
+    return float(value)
+
+def parse_spec(field: str, spec: str) -> list[Any]:
+    if (match := re.fullmatch(r'([^:]+):([^:]+):([^:]+)', spec)) is not None and field != 'adaptive_type':
+        start, stop, step = (float(x) for x in match.groups())
+        if step <= 0:
+            raise ValueError(f'Step of sweep range "{spec}" should be positive')
+
+        # Add some tolerance so that the stop value is included despite rounding errors.
+        count = int((stop - start) / step + 1e-9) + 1
+        values = [round(start + n * step, 12) for n in range(count)]
+        return [parse_value(field, str(int(x)) if x.is_integer() else str(x)) for x in values]
+
+    return [parse_value(field, x.strip()) for x in spec.split(',')]
+
+# Parse a single FIELD=SPEC sweep parameter, returning the name of the parameter,
+# the field of RWArgs it changes, the CS it applies to (for per-CS parameters), and
+# the list of values.
+def parse_sweep(sweep: str) -> tuple[str, str, None | str, list[Any]]:
+    name, sep, spec = sweep.partition('=')
+    if not sep or not spec:
+        raise ValueError(f'Sweep "{sweep}" should have the format FIELD=SPEC')
+
+    name = name.strip().replace('-', '_')
+    if (match := re.fullmatch(r'(alpha|alpha_mack|alpha_hall|salience|habituation)_([A-Z])', name)) is not None:
+        field, cs = per_cs_fields[match.group(1)], match.group(2)
+        return name, field, cs, parse_spec(field, spec)
+
+    if name not in {f.name for f in fields(RWArgs)}:
+        raise ValueError(f'Cannot sweep "{name}", since it is not a parameter')
+
+    return name, name, None, parse_spec(name, spec)
+
+# Returns every combination of values of the sweeps, as a list of the values of each
+# combination along with the arguments to run it.
+def sweep_points(args: argparse.Namespace, sweeps: list[tuple[str, str, None | str, list[Any]]]) -> list[tuple[tuple[Any, ...], argparse.Namespace]]:
+    points = []
+    for values in product(*[v for _, _, _, v in sweeps]):
+        point_args = argparse.Namespace(**vars(args))
+        for field in per_cs_fields.values():
+            setattr(point_args, field, dict(getattr(args, field)))
+
+        for (_, field, cs, _), value in zip(sweeps, values):
+            if cs is None:
+                setattr(point_args, field, value)
+            else:
+                getattr(point_args, field)[cs] = value
+
+        points.append((values, point_args))
+
+    return points
+
+# Run the experiments for a single combination of values, returning one row per
+# group, phase, CS, and step.
+def run_point(experiments: list[Experiment], args: argparse.Namespace, steps: list[int]) -> list[list[Any]]:
+    rows = []
+    for experiment, strengths in zip(experiments, run_experiments(experiments, args)):
+        for phase_num, phase_strengths in enumerate(strengths, start = 1):
+            for key, hist in phase_strengths.items():
+                cs = key.removeprefix(f'{experiment.name} - ')
+                for step in sorted({step % len(hist) for step in steps if -len(hist) <= step < len(hist)}):
+                    rows.append([experiment.name, phase_num, cs, step, *hist.values[:, step].tolist()])
+
+    return rows
+
+# Run every point of the sweep in `jobs` processes (every core if it's None) and
+# write the results as a CSV table to `output`, in the order of the points. The
+# columns of the swept parameters are prefixed with `param_`, since many of them
+# (such as `alpha` or `salience`) are also fields of the values of every CS.
+def run_sweep(experiments: list[Experiment], args: argparse.Namespace, sweeps: list[str], steps: list[int], output: TextIO, jobs: None | int = None):
+    parsed = [parse_sweep(x) for x in sweeps]
+    points = sweep_points(args, parsed)
+
+    writer = csv.writer(output)
+    writer.writerow([f'param_{name}' for name, _, _, _ in parsed] + ['group', 'phase', 'cs', 'step', *Stimulus.fields])
+
+    def write(results):
+        for (values, _), rows in zip(points, results):
+            for row in rows:
+                writer.writerow([*values, *row])
+
+    if jobs == 1:
+        write(run_point(experiments, a, steps) for _, a in points)
+        return
+
+    with ProcessPoolExecutor(max_workers = jobs) as executor:
+        write(executor.map(run_point, repeat(experiments), [a for _, a in points], repeat(steps)))